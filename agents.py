@@ -0,0 +1,17 @@
+import random
+
+
+class RandomAgent:
+    def __init__(self, rng=None):
+        self.rng = rng if rng is not None else random.Random()
+
+    def choose(self, game):
+        options = len(game.moves)
+        n = game.number_of_moves_to_choose
+        if isinstance(n, tuple):
+            count = self.rng.randint(n[0], min(n[1], options))
+            return self.rng.sample(range(options), count)
+        elif n == 1:
+            return self.rng.randrange(options)
+        else:
+            return self.rng.sample(range(options), n)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from mottainai import CARDS, CARD_BY_ID, MATERIALS, METAL, PAPER, STONE, CLOTH, CLAY, Action, Game, TASK_ACTIONS
+
+# Lockstep engine for many games at once, for rollouts with simple policies.
+# Every game is a row: the zone of each card id, hand visibility and the
+# deck order. All live games play the same phase of a turn together, so the
+# rules below mirror Game.handle_state phase by phase. Cancels are never
+# chosen. cross_check() replays the batch decisions through Game to prove
+# both engines agree.
+
+CARD_COUNT = len(CARD_BY_ID)
+# Ring buffer for the deck; returned cards go to the back. At most 54 cards
+# are in it at once
+DECK_SLOTS = 64
+
+CARD_MATERIAL = np.zeros(CARD_COUNT, np.int64)
+MATERIAL_VALUE = np.zeros(len(MATERIALS) + 1, np.int64)
+MATERIAL_ONE_HOT = np.zeros((CARD_COUNT, len(MATERIALS) + 1), np.float32)
+for c in CARDS:
+    CARD_MATERIAL[c.id] = c.material.id
+    MATERIAL_ONE_HOT[c.id, c.material.id] = 1
+for m in MATERIALS:
+    MATERIAL_VALUE[m.id] = m.value
+CARD_VALUE = MATERIAL_VALUE[CARD_MATERIAL]
+# The first player is the one whose dealt floor card comes first by name
+NAME_RANK = np.zeros(CARD_COUNT, np.int64)
+for rank, c in enumerate(sorted(CARDS, key=lambda c: c.name.lower())):
+    NAME_RANK[c.id] = rank
+TASK_ACTION_BY_MATERIAL = np.zeros(len(MATERIALS) + 1, np.int64)
+for m, action in TASK_ACTIONS.items():
+    TASK_ACTION_BY_MATERIAL[m.id] = action
+
+# Zone codes. Column 0 of the zone array is never a card and holds NO_CARD
+NO_CARD = -1
+COMPLETED = -2
+DECK = 0
+FLOOR = 1
+HAND, TASK, INITIAL_TASK, WAITING_AREA, CRAFT_BENCH, HELPERS, SALES, GALLERY, GIFT_SHOP = range(9)
+PLAYER_ZONE_COUNT = 9
+
+# Indices into the allowed actions of choose_action
+TASK_ACTION, CRAFT_ACTION, PRAY_ACTION = range(3)
+
+
+def zone_code(player, zone):
+    return 2 + player * PLAYER_ZONE_COUNT + zone
+
+
+def nth_card(options, k):
+    # The card id of the k-th option of each row, in card id order
+    return (options.cumsum(1) > k[:, None]).argmax(1)
+
+
+def random_card(rng, options):
+    # One uniformly chosen card id per row, 0 for rows with no options
+    count = options.sum(1)
+    k = (rng.random(len(options)) * count).astype(np.int64)
+    return np.where(count > 0, nth_card(options, k), 0)
+
+
+def random_cards(rng, options, count):
+    # count[i] distinct card ids per row in random order, padded with 0
+    width = int(count.max(initial=0))
+    keys = rng.random(options.shape, np.float32)
+    keys[~options] = 2
+    order = keys.argsort(1)[:, :width]
+    return np.where(np.arange(width) < count[:, None], order, 0)
+
+
+class RandomPolicy:
+    # Same choice distribution as agents.RandomAgent. Every method gets the
+    # game, the rows deciding and their options, one row each
+    def choose_task(self, game, rows, hand):
+        # Uniform over the hand cards and praying, which is 0
+        count = hand.sum(1)
+        k = (game.rng.random(len(rows)) * (count + 1)).astype(np.int64)
+        return np.where(k < count, nth_card(hand, k), 0)
+
+    def choose_action(self, game, rows, allowed):
+        count = allowed.sum(1)
+        k = (game.rng.random(len(rows)) * count).astype(np.int64)
+        return (allowed.cumsum(1) > k[:, None]).argmax(1)
+
+    def choose_card(self, game, rows, options):
+        return random_card(game.rng, options)
+
+    def choose_cards(self, game, rows, options, count):
+        return random_cards(game.rng, options, count)
+
+    def choose_return_count(self, game, rows, max_count):
+        return game.rng.integers(0, max_count + 1)
+
+    def choose_wing(self, game, rows, players, cards):
+        return np.where(game.rng.random(len(rows)) < 0.5, GALLERY, GIFT_SHOP)
+
+
+class GreedyPolicy(RandomPolicy):
+    # Completes works whenever it can and only prays when nothing else is
+    # allowed. Works go to the gift shop while they would cover more sales
+    def choose_action(self, game, rows, allowed):
+        return np.where(allowed[:, CRAFT_ACTION], CRAFT_ACTION,
+                        np.where(allowed[:, TASK_ACTION], TASK_ACTION, PRAY_ACTION))
+
+    def choose_wing(self, game, rows, players, cards):
+        zone = game.zone[rows]
+        material = CARD_MATERIAL[cards]
+        ix = np.arange(len(rows))
+        sales = material_counts(in_zone(zone, players, SALES))[ix, material]
+        gift_shop = material_counts(in_zone(zone, players, GIFT_SHOP))[ix, material]
+        return np.where(sales > gift_shop * MATERIAL_VALUE[material], GIFT_SHOP, GALLERY)
+
+
+def in_zone(zone, players, code):
+    return zone == zone_code(players, code)[:, None]
+
+
+def material_counts(cards):
+    # A float matrix product goes through BLAS, unlike an integer one
+    return (cards.astype(np.float32) @ MATERIAL_ONE_HOT).astype(np.int64)
+
+
+class BatchGame:
+    # Phases take rows, the indices of the games they apply to, and a, the
+    # active player of each of those games. Arrays named after zones are
+    # card masks over those rows only.
+    def __init__(self, count, player_count=2, rng=None, policy=None, record=False):
+        self.count = count
+        self.player_count = player_count
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.policy = policy if policy is not None else RandomPolicy()
+        self.zone = np.zeros((count, CARD_COUNT), np.int8)
+        self.visible = np.zeros((count, CARD_COUNT), bool)
+        self.deck = np.zeros((count, DECK_SLOTS), np.int64)
+        self.top = np.zeros(count, np.int64)
+        self.end = np.zeros(count, np.int64)
+        self.active = np.zeros(count, np.int64)
+        self.first_player = np.zeros(count, np.int64)
+        self.turn_number = np.ones(count, np.int64)
+        self.over = np.zeros(count, bool)
+        self.initial_order = None
+        # When record is set, each game's decisions are kept as what
+        # Game.moves would offer, for cross_check()
+        self.decisions = [[] for _ in range(count)] if record else None
+
+    def deal(self):
+        n = self.count
+        order = self.rng.random((n, len(CARDS))).argsort(1) + 1
+        self.initial_order = order
+        self.deck[:, :len(CARDS)] = order
+        self.end[:] = len(CARDS)
+        self.zone[:, 0] = NO_CARD
+        self.zone[:, 1:] = DECK
+        rows = np.arange(n)
+        floor_cards = []
+        for p in range(self.player_count):
+            start = p * 7
+            self.zone[rows[:, None], order[:, start:start + 5]] = zone_code(p, HAND)
+            self.zone[rows, order[:, start + 5]] = zone_code(p, INITIAL_TASK)
+            self.zone[rows, order[:, start + 6]] = FLOOR
+            floor_cards.append(order[:, start + 6])
+        self.top[:] = 7 * self.player_count
+        self.active = NAME_RANK[np.stack(floor_cards, 1)].argmin(1)
+        self.first_player = self.active.copy()
+
+    def run(self):
+        self.deal()
+        while not self.over.all():
+            self.play_turn()
+        return self.scores()
+
+    def record(self, rows, moves):
+        if self.decisions is None:
+            return
+        for row, move in zip(rows, moves):
+            if isinstance(move, np.ndarray):
+                self.decisions[row].append([int(m) for m in move if m & 63])
+            else:
+                self.decisions[row].append(int(move))
+
+    def live(self, rows, *arrays):
+        # Drops the games that ended, along with their entries in arrays
+        keep = ~self.over[rows]
+        return (rows[keep],) + tuple(x[keep] for x in arrays)
+
+    def set_zone(self, rows, cards, codes):
+        real = cards != 0
+        rows, cards = rows[real], cards[real]
+        self.zone[rows, cards] = codes[real] if np.ndim(codes) else codes
+        self.visible[rows, cards] = False
+
+    def draw(self, rows, counts, codes):
+        for k in range(int(counts.max(initial=0))):
+            want = (k < counts) & ~self.over[rows]
+            available = want & (self.top[rows] < self.end[rows])
+            r = rows[available]
+            self.set_zone(r, self.deck[r, self.top[r] % DECK_SLOTS], codes[available])
+            self.top[r] += 1
+            self.over[rows[want & ~available]] = True
+
+    def return_cards(self, rows, cards):
+        for k in range(cards.shape[1]):
+            returning = cards[:, k] != 0
+            r = rows[returning]
+            self.deck[r, self.end[r] % DECK_SLOTS] = cards[returning, k]
+            self.set_zone(r, cards[returning, k], DECK)
+            self.end[r] += 1
+
+    def play_turn(self):
+        rows = np.flatnonzero(~self.over)
+        a = self.active[rows]
+        self.reduce_hand(rows, a)
+        self.discard_old_task(rows, a)
+        self.choose_new_task(rows, a)
+        for k in range(1, self.player_count):
+            rows, a = self.live(rows, a)
+            self.perform_task(rows, a, self.task_of(rows, (a + k) % self.player_count), pray_if_none=False)
+        rows, a = self.live(rows, a)
+        self.perform_task(rows, a, self.task_of(rows, a), pray_if_none=True)
+        rows, a = self.live(rows, a)
+        waiting = np.nonzero(in_zone(self.zone[rows], a, WAITING_AREA))
+        self.zone[rows[waiting[0]], waiting[1]] = zone_code(a[waiting[0]], HAND)
+        self.active[rows] = (a + 1) % self.player_count
+        self.turn_number[rows] += self.active[rows] == self.first_player[rows]
+
+    def task_of(self, rows, players):
+        task = in_zone(self.zone[rows], players, TASK)
+        return np.where(task.any(1), task.argmax(1), 0)
+
+    def reduce_hand(self, rows, a):
+        hand = in_zone(self.zone[rows], a, HAND)
+        size = hand.sum(1)
+        reducing = size > 5
+        if not reducing.any():
+            return
+        rows, a, hand, size = rows[reducing], a[reducing], hand[reducing], size[reducing]
+        cards = self.policy.choose_cards(self, rows, hand, size - 5)
+        self.record(rows, Action.RETURN << 6 | cards)
+        self.return_cards(rows, cards)
+        self.visible[rows] &= ~hand
+
+    def discard_old_task(self, rows, a):
+        zone = self.zone[rows]
+        old = np.nonzero(in_zone(zone, a, INITIAL_TASK) | in_zone(zone, a, TASK))
+        self.zone[rows[old[0]], old[1]] = FLOOR
+
+    def choose_new_task(self, rows, a):
+        hand = in_zone(self.zone[rows], a, HAND)
+        choosing = hand.any(1)
+        rows, a, hand = rows[choosing], a[choosing], hand[choosing]
+        task = self.policy.choose_task(self, rows, hand)
+        self.record(rows, np.where(task != 0, Action.TASK << 6 | task, Action.PRAY << 6))
+        self.set_zone(rows, task, zone_code(a, TASK))
+
+    def perform_task(self, rows, a, task, pray_if_none):
+        if pray_if_none:
+            none = task == 0
+            self.draw(rows[none], np.ones(none.sum(), np.int64), zone_code(a[none], WAITING_AREA))
+        performing = task != 0
+        rows, a, material = rows[performing], a[performing], CARD_MATERIAL[task[performing]]
+        zone = self.zone[rows]
+        ix = np.arange(len(rows))
+        helpers = material_counts(in_zone(zone, a, HELPERS))[ix, material]
+        gallery = material_counts(in_zone(zone, a, GALLERY))[ix, material]
+        actions = 1 + helpers + np.where(helpers <= gallery * MATERIAL_VALUE[material], helpers, 0)
+        # Every action is taken, so a game with more actions just goes on
+        # for more rounds
+        for n in range(int(actions.max(initial=0))):
+            acting = (n < actions) & ~self.over[rows]
+            rows, a, material, actions = rows[acting], a[acting], material[acting], actions[acting]
+            if not len(rows):
+                break
+            self.perform_action(rows, a, material)
+
+    def perform_action(self, rows, a, material):
+        zone = self.zone[rows]
+        ix = np.arange(len(rows))
+        hand = in_zone(zone, a, HAND)
+        hand_counts = material_counts(hand)
+        bench = in_zone(zone, a, CRAFT_BENCH)
+        floor = zone == FLOOR
+        smith_works = hand_counts >= MATERIAL_VALUE
+        smith_works[:, 0] = False
+        craft_works = (hand_counts > 0) & (material_counts(bench) >= MATERIAL_VALUE - 1)
+
+        task_allowed = np.select(
+            [material == PAPER.id, (material == STONE.id) | (material == CLAY.id), material == METAL.id],
+            [bench.any(1), floor.any(1), smith_works.any(1)],
+            True)
+        allowed = np.stack([task_allowed, craft_works[ix, material], np.ones(len(rows), bool)], 1)
+        choice = self.policy.choose_action(self, rows, allowed)
+        action = np.select(
+            [choice == TASK_ACTION, choice == CRAFT_ACTION], [TASK_ACTION_BY_MATERIAL[material], Action.CRAFT],
+            Action.PRAY)
+        self.record(rows, action << 6)
+
+        tasking = choice == TASK_ACTION
+        for task_material, options, action, target in (
+                (PAPER, bench, Action.SELL, SALES),
+                (STONE, floor, Action.HIRE, HELPERS),
+                (CLAY, floor, Action.COLLECT, CRAFT_BENCH)):
+            chosen = tasking & (material == task_material.id)
+            if chosen.any():
+                card = self.policy.choose_card(self, rows[chosen], options[chosen])
+                self.record(rows[chosen], action << 6 | card)
+                self.set_zone(rows[chosen], card, zone_code(a[chosen], target))
+        tailor = tasking & (material == CLOTH.id)
+        if tailor.any():
+            self.tailor(rows[tailor], a[tailor], zone[tailor], hand[tailor])
+        smith = tasking & (material == METAL.id)
+        if smith.any():
+            self.smith(rows[smith], a[smith], hand[smith], smith_works[smith])
+        craft = choice == CRAFT_ACTION
+        if craft.any():
+            options = hand[craft] & (CARD_MATERIAL == material[craft][:, None])
+            card = self.policy.choose_card(self, rows[craft], options)
+            self.record(rows[craft], Action.CRAFT_WORK << 6 | card)
+            self.complete_work(rows[craft], a[craft], card)
+        pray = choice == PRAY_ACTION
+        if pray.any():
+            self.draw(rows[pray], np.ones(pray.sum(), np.int64), zone_code(a[pray], WAITING_AREA))
+
+    def tailor(self, rows, a, zone, hand):
+        hand_size = hand.sum(1)
+        waiting_size = in_zone(zone, a, WAITING_AREA).sum(1)
+        max_count = np.minimum(np.maximum(0, 5 - waiting_size), hand_size)
+        count = self.policy.choose_return_count(self, rows, max_count)
+        cards = self.policy.choose_cards(self, rows, hand, count)
+        # With an empty hand there is nothing to choose
+        deciding = hand_size > 0
+        self.record(rows[deciding], Action.RETURN << 6 | cards[deciding])
+        self.return_cards(rows, cards)
+        returning = count > 0
+        self.visible[rows[returning]] &= ~hand[returning]
+        refill = np.maximum(0, 5 - (hand_size - count) - waiting_size)
+        self.draw(rows, refill, zone_code(a, WAITING_AREA))
+
+    def smith(self, rows, a, hand, smith_works):
+        ix = np.arange(len(rows))
+        card = self.policy.choose_card(self, rows, hand & smith_works[ix[:, None], CARD_MATERIAL])
+        self.record(rows, Action.SMITH_WORK << 6 | card)
+        self.zone[rows, card] = COMPLETED
+        self.visible[rows, card] = False
+
+        same = hand & (CARD_MATERIAL == CARD_MATERIAL[card][:, None])
+        same[ix, card] = False
+        visible = self.visible[rows]
+        need = np.maximum(0, CARD_VALUE[card] - 1 - (same & visible).sum(1))
+        revealing = need > 0
+        if revealing.any():
+            cards = self.policy.choose_cards(
+                self, rows[revealing], same[revealing] & ~visible[revealing], need[revealing])
+            self.record(rows[revealing], Action.REVEAL << 6 | cards)
+            revealed = np.repeat(rows[revealing], cards.shape[1])
+            cards = cards.ravel()
+            self.visible[revealed[cards != 0], cards[cards != 0]] = True
+        self.complete_work(rows, a, card)
+
+    def complete_work(self, rows, a, card):
+        wing = self.policy.choose_wing(self, rows, a, card)
+        self.record(rows, np.where(wing == GALLERY, Action.GALLERY << 6, Action.GIFT_SHOP << 6))
+        codes = zone_code(a, wing)
+        self.set_zone(rows, card, codes)
+        self.over[rows[(self.zone[rows] == codes[:, None]).sum(1) == 5]] = True
+
+    def scores(self):
+        # [games, players], as Player.score
+        scores = np.zeros((self.count, self.player_count), np.int64)
+        for p in range(self.player_count):
+            players = np.full(self.count, p)
+            works = in_zone(self.zone, players, GALLERY) | in_zone(self.zone, players, GIFT_SHOP)
+            sales = material_counts(in_zone(self.zone, players, SALES))
+            gift_shop = material_counts(in_zone(self.zone, players, GIFT_SHOP))
+            covered = sales <= gift_shop * MATERIAL_VALUE
+            scores[:, p] = (works * CARD_VALUE).sum(1) + (np.where(covered, sales, 0) * MATERIAL_VALUE).sum(1)
+        return scores
+
+
+class ScriptedAgent:
+    # Plays recorded decisions, given as the move ints Game.moves offers
+    def __init__(self, decisions):
+        self.decisions = iter(decisions)
+
+    def choose(self, game):
+        move = next(self.decisions)
+        if isinstance(move, list):
+            return [game.moves.index(m) for m in move]
+        return game.moves.index(move)
+
+
+def cross_check(count=200, player_count=2, seed=0, policy=None):
+    # Replays every batch game through Game and compares the outcome
+    batch = BatchGame(count, player_count, np.random.default_rng(seed), policy, record=True)
+    scores = batch.run()
+    for i in range(count):
+        game = Game(verbose=False)
+        game.deal(player_count, [CARD_BY_ID[c] for c in batch.initial_order[i]])
+        game.agents = [ScriptedAgent(batch.decisions[i])] * player_count
+        game.run()
+        expected = [p.score for p in game.players]
+        zones = {c.id: FLOOR for c in game.floor}
+        for p, player in enumerate(game.players):
+            for zone, cards in (
+                    (HAND, [c.card for c in player.hand]), (WAITING_AREA, player.waiting_area),
+                    (CRAFT_BENCH, player.craft_bench), (HELPERS, player.helpers), (SALES, player.sales),
+                    (GALLERY, player.gallery), (GIFT_SHOP, player.gift_shop)):
+                zones.update((c.id, zone_code(p, zone)) for c in cards)
+        if any(batch.zone[i, card] != zone for card, zone in zones.items()):
+            raise AssertionError(f'Game {i}: cards are in different zones')
+        if expected != list(scores[i]) or game.turn_number != batch.turn_number[i]:
+            raise AssertionError(
+                f'Game {i}: batch scores {list(scores[i])} in {batch.turn_number[i]} turns, '
+                f'engine scores {expected} in {game.turn_number} turns')
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play random games in lockstep with NumPy')
+    parser.add_argument('-n', '--games', type=int, default=10000)
+    parser.add_argument('-p', '--players', type=int, default=2)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('--greedy', action='store_true', help='use GreedyPolicy instead of RandomPolicy')
+    parser.add_argument('--check', action='store_true', help='cross-check against the Game engine')
+    args = parser.parse_args()
+
+    policy = GreedyPolicy() if args.greedy else RandomPolicy()
+    if args.check:
+        print(f'{cross_check(args.games, args.players, args.seed, policy)} games match the Game engine')
+        return
+    start = time.perf_counter()
+    scores = BatchGame(args.games, args.players, np.random.default_rng(args.seed), policy).run()
+    elapsed = time.perf_counter() - start
+    print(f'{args.games} games in {elapsed:.2f}s - {args.games / elapsed:.1f} games/s')
+    wins = (scores == scores.max(1, keepdims=True)).sum(0)
+    for i, w in enumerate(wins):
+        print(f'Player {i + 1}: {w} wins (ties included)')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
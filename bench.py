@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from mottainai import CARDS, Deck, Game, ListBackend, State
+from agents import RandomAgent
+from cardset import BitsetBackend
+from profiling import Profiler
+from zobrist import ZobristBackend, attach
+
+# Every benchmark runs from a fixed seed, so a given -n, -p and -s always
+# measures the same work. -o writes the results as JSON; --baseline compares
+# them with an earlier -o file and exits with status 1 when a benchmark got
+# slower than the threshold allows.
+
+BACKENDS = {
+    'list': ListBackend,
+    'bitset': BitsetBackend,
+    'zobrist': ZobristBackend,
+}
+
+
+def new_game(player_count, rng, backend=ListBackend, profiler=None):
+    # A dealt game. Zobrist zones only keep their hashes once attached, so
+    # the zobrist benchmarks include the cost of hashing
+    game = Game(verbose=False, rng=rng, backend=backend)
+    if profiler:
+        profiler.attach(game)
+    game.deal(player_count)
+    if backend is ZobristBackend:
+        attach(game)
+    return game
+
+
+def play_random_game(player_count, rng, backend=ListBackend, profiler=None):
+    game = new_game(player_count, rng, backend, profiler)
+    game.agents = [RandomAgent(rng) for _ in range(player_count)]
+    game.run()
+    return game
+
+
+def midgame_positions(player_count, rng, backend, count, keep=None):
+    # Positions sampled from random games, for the benchmarks that work on
+    # single positions. keep filters which positions may be sampled
+    positions = []
+    while len(positions) < count:
+        game = new_game(player_count, rng, backend)
+        game.agents = [RandomAgent(rng) for _ in range(player_count)]
+        while game.state != State.GAME_OVER:
+            game.step()
+            if (keep is None or keep(game)) and rng.random() < 0.05:
+                positions.append(game.clone())
+    return positions[:count]
+
+
+# Each benchmark returns how many operations it timed, the unit name and the
+# elapsed seconds
+
+def bench_games(args, backend, rng):
+    start = time.perf_counter()
+    for _ in range(args.games):
+        play_random_game(args.players, rng, backend, args.profiler)
+    return args.games, 'games', time.perf_counter() - start
+
+
+def bench_steps(args, backend, rng):
+    steps = 0
+    start = time.perf_counter()
+    for _ in range(args.games):
+        game = new_game(args.players, rng, backend, args.profiler)
+        agent = RandomAgent(rng)
+        while game.state != State.GAME_OVER:
+            game.apply(agent.choose(game) if game.moves else None)
+            steps += 1
+    return steps, 'steps', time.perf_counter() - start
+
+
+def bench_clone(args, backend, rng):
+    positions = midgame_positions(args.players, rng, backend, 100)
+    clones = args.games * 10
+    start = time.perf_counter()
+    for i in range(clones):
+        positions[i % len(positions)].clone()
+    return clones, 'clones', time.perf_counter() - start
+
+
+def bench_undo(args, backend, rng):
+    positions = midgame_positions(args.players, rng, backend, 100, lambda g: g.state != State.GAME_OVER)
+    agent = RandomAgent(rng)
+    for game in positions:
+        game.undo_log = []
+    pairs = args.games * 10
+    start = time.perf_counter()
+    for i in range(pairs):
+        game = positions[i % len(positions)]
+        game.apply(agent.choose(game) if game.moves else None)
+        game.undo()
+    return pairs, 'apply/undo pairs', time.perf_counter() - start
+
+
+def bench_moves(args, backend, rng):
+    # Runs the states between a decision and the next one, which is where
+    # legal moves are generated, then undoes back to the start
+    positions = midgame_positions(args.players, rng, backend, 100,
+                                  lambda g: not g.moves and g.state != State.GAME_OVER)
+    for game in positions:
+        game.undo_log = []
+    decisions = args.games * 10
+    start = time.perf_counter()
+    for i in range(decisions):
+        game = positions[i % len(positions)]
+        game.step_until_decision()
+        for _ in range(len(game.undo_log)):
+            game.undo()
+    return decisions, 'decisions', time.perf_counter() - start
+
+
+def bench_draw(args, backend, rng):
+    # Deck does not depend on the backend
+    deck = Deck(rng.sample(CARDS, len(CARDS)))
+    cycles = args.games * 100
+    start = time.perf_counter()
+    for _ in range(cycles):
+        card = deck.draw()
+        cards = deck.draw(3)
+        deck.return_cards(card)
+        deck.return_cards(cards)
+    return cycles, 'draw/return cycles', time.perf_counter() - start
+
+
+def bench_add_to_hand(args, backend, rng):
+    hands = []
+    for game in midgame_positions(args.players, rng, backend, 100):
+        hand = game.active_player.hand
+        held = {c.card.id for c in hand}
+        hands.append((hand, [c for c in rng.sample(CARDS, 10) if c.id not in held][:2]))
+    adds = args.games * 10
+    elapsed = 0
+    for done in range(0, adds, len(hands)):
+        # Copies are made outside the timed loop
+        batch = [(hand.copy(), cards) for hand, cards in hands[:adds - done]]
+        start = time.perf_counter()
+        for hand, cards in batch:
+            hand.add_to_hand(cards)
+        elapsed += time.perf_counter() - start
+    return adds, 'adds', elapsed
+
+
+def bench_cover(args, backend, rng):
+    players = [p for game in midgame_positions(args.players, rng, backend, 100) for p in game.players]
+    calls = args.games * 10
+    start = time.perf_counter()
+    for i in range(calls):
+        p = players[i % len(players)]
+        p.covered_helpers
+        p.covered_sales_value
+        p.score
+    return calls, 'players', time.perf_counter() - start
+
+
+def bench_completeable(args, backend, rng):
+    positions = midgame_positions(args.players, rng, backend, 100)
+    calls = args.games * 10
+    start = time.perf_counter()
+    for i in range(calls):
+        positions[i % len(positions)].find_completeable_works()
+    return calls, 'calls', time.perf_counter() - start
+
+
+BENCHMARKS = {
+    'games': bench_games,
+    'steps': bench_steps,
+    'clone': bench_clone,
+    'undo': bench_undo,
+    'moves': bench_moves,
+    'draw': bench_draw,
+    'add_to_hand': bench_add_to_hand,
+    'cover': bench_cover,
+    'completeable': bench_completeable,
+}
+# Benchmarks that measure the same code with every backend
+SHARED = {'draw'}
+
+
+def run_benchmark(args, bench_name, backend_name):
+    # Best of --repeat runs, each from the same seed
+    best = None
+    for _ in range(args.repeat):
+        args.profiler = Profiler() if args.profile else None
+        count, unit, elapsed = BENCHMARKS[bench_name](args, BACKENDS[backend_name], random.Random(args.seed))
+        if best is None or elapsed < best['seconds']:
+            best = {'count': count, 'unit': unit, 'seconds': elapsed, 'rate': count / elapsed}
+    return best
+
+
+def compare(results, baseline, threshold):
+    # Names of the benchmarks whose rate fell more than threshold below the
+    # baseline's
+    regressions = []
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        change = result['rate'] / old['rate'] - 1
+        marker = ''
+        if change < -threshold:
+            regressions.append(name)
+            marker = '  REGRESSION'
+        print(f'{name}: {old["rate"]:.0f} -> {result["rate"]:.0f} {result["unit"]}/s ({change:+.1%}){marker}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure headless engine throughput')
+    parser.add_argument('-n', '--games', type=int, default=1000)
+    parser.add_argument('-p', '--players', type=int, default=2)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-b', '--backend', choices=sorted(BACKENDS) + ['all'], default='all')
+    parser.add_argument('-k', '--benchmark', choices=sorted(BENCHMARKS) + ['all'], default='all')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='keep the best of this many runs')
+    parser.add_argument('-o', '--output', help='write the results as JSON')
+    parser.add_argument('--baseline', help='compare with the JSON results of an earlier run')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='largest slowdown against the baseline that is not a regression')
+    parser.add_argument('-P', '--profile', action='store_true',
+                        help='time every state of the games and steps benchmarks and print a report')
+    args = parser.parse_args()
+
+    backends = BACKENDS if args.backend == 'all' else [args.backend]
+    benchmarks = BENCHMARKS if args.benchmark == 'all' else [args.benchmark]
+    results = {}
+    for bench_name in benchmarks:
+        for name in backends:
+            key = bench_name if bench_name in SHARED else f'{bench_name}/{name}'
+            if key in results:
+                continue
+            result = results[key] = run_benchmark(args, bench_name, name)
+            print(f'{key}: {result["count"]} {result["unit"]} in {result["seconds"]:.2f}s - '
+                  f'{result["rate"]:.0f} {result["unit"]}/s')
+            if args.profiler and any(t.count for t in args.profiler.states.values()):
+                print(args.profiler.report())
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'games': args.games,
+                'players': args.players,
+                'seed': args.seed,
+                'results': results,
+            }, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline['games'], baseline['players'], baseline['seed']) != (args.games, args.players, args.seed):
+            print('Warning: the baseline was run with different -n, -p or -s')
+        if compare(results, baseline, args.threshold):
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+
+from mottainai import CARD_BY_ID, COUNTS_STRIDE
+
+# Apart from dealing, the rules only ever look at a card's material, so
+# positions that differ only in which card of a material sits where play out
+# the same. canonical_key() maps a Game to material counts per zone and the
+# progress of the current turn, so all of them share one key.
+#
+# Card identity matters in two places, and both are handled:
+# - deal() picks the first player by card name. Keys exist only for dealt
+#   games, which hold the result in first_player_ix, and that is part of the
+#   key because it decides when a new turn number starts.
+# - The deck order decides future draws. It is only in the key as a
+#   sequence of materials, and only with deck_order=True. Without it, keys
+#   stand for every ordering of the same deck, which suits evaluations that
+#   average over the unknown deck anyway.
+# turn_number is left out, as no rule reads it.
+
+
+def material_vector(cards):
+    counts = [0] * COUNTS_STRIDE
+    for c in cards:
+        counts[c.material.id] += 1
+    return bytes(counts)
+
+
+def material_id(card):
+    return card.material.id if card is not None else 0
+
+
+def canonical_move(move):
+    # The action with the card's material in place of its id
+    card_id = move & 63
+    return move - card_id + (CARD_BY_ID[card_id].material.id if card_id else 0)
+
+
+def canonical_key(game, deck_order=False):
+    if game.players is None:
+        raise ValueError('Only dealt games have a canonical key')
+    players = tuple(
+        (
+            tuple(p.zone_counts),
+            material_vector(c.card for c in p.hand.revealed_cards),
+            material_vector(p.waiting_area),
+            material_id(p.task),
+            material_id(p.initial_task),
+        )
+        for p in game.players
+    )
+    deck = game.deck
+    if deck_order:
+        deck_key = bytes(c.material.id for c in deck.cards[deck.top:])
+    else:
+        deck_key = material_vector(deck.cards[deck.top:])
+    return (
+        game.state.value,
+        game.active_player_ix,
+        game.first_player_ix,
+        players,
+        material_vector(game.floor),
+        deck_key,
+        deck.exhausted,
+        material_id(game.current_task_to_perform),
+        game.current_task_is_of_opponent,
+        game.actions_to_perform,
+        game.current_action_num,
+        material_id(game.completed_work),
+        tuple(s.value for s in game.next_states),
+        None if game.opponents_with_tasks is None else len(game.opponents_with_tasks),
+        None if game.moves is None else tuple(sorted(canonical_move(m) for m in game.moves)),
+        game.number_of_moves_to_choose,
+        game.allow_cancel,
+    )
+
+
+class EvaluationCache:
+    # Agent evaluations by canonical key, evicting the least recently used
+    # entry once maxsize are held
+    def __init__(self, maxsize=1 << 16, deck_order=False):
+        self.maxsize = maxsize
+        self.deck_order = deck_order
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, game):
+        return canonical_key(game, self.deck_order)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def evaluate(self, game, evaluate):
+        # evaluate(game), computed once per canonical position
+        key = self.key(game)
+        value = self.get(key)
+        if value is None:
+            value = evaluate(game)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
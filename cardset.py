@@ -0,0 +1,223 @@
+from collections import Counter
+
+from mottainai import CARDS, CARD_BY_ID, HandCard
+
+# Card ids run from 1 to 54, so any set of cards fits in a 64-bit mask with
+# bit card.id set. Iteration is always in card id order, which matches the
+# sort order of a Hand.
+MATERIAL_MASKS = {}
+for c in CARDS:
+    MATERIAL_MASKS[c.material] = MATERIAL_MASKS.get(c.material, 0) | (1 << c.id)
+
+
+def iter_mask(mask):
+    while mask:
+        low = mask & -mask
+        yield CARD_BY_ID[low.bit_length() - 1]
+        mask ^= low
+
+
+def nth_bit(mask, i):
+    if i < 0:
+        i += mask.bit_count()
+    if i < 0:
+        raise IndexError('card index out of range')
+    for _ in range(i):
+        mask &= mask - 1
+    if not mask:
+        raise IndexError('card index out of range')
+    return mask & -mask
+
+
+def material_counts(mask):
+    counts = Counter()
+    for material, material_mask in MATERIAL_MASKS.items():
+        count = (mask & material_mask).bit_count()
+        if count:
+            counts[material] = count
+    return counts
+
+
+def mask_of(cards):
+    mask = 0
+    for c in cards:
+        mask |= 1 << c.id
+    return mask
+
+
+class CardSet:
+    __slots__ = ('mask',)
+
+    def __init__(self, cards=()):
+        self.mask = mask_of(cards)
+
+    def __len__(self):
+        return self.mask.bit_count()
+
+    def __bool__(self):
+        return self.mask != 0
+
+    def __iter__(self):
+        return iter_mask(self.mask)
+
+    def __contains__(self, card):
+        return (self.mask >> card.id) & 1 == 1
+
+    def __getitem__(self, i):
+        return CARD_BY_ID[nth_bit(self.mask, i).bit_length() - 1]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, card):
+        self.mask |= 1 << card.id
+
+    def extend(self, cards):
+        self.mask |= mask_of(cards)
+
+    def remove(self, card):
+        bit = 1 << card.id
+        if not self.mask & bit:
+            raise ValueError(f'{card} not in card set')
+        self.mask ^= bit
+
+    def pop(self, i=-1):
+        bit = nth_bit(self.mask, i)
+        self.mask ^= bit
+        return CARD_BY_ID[bit.bit_length() - 1]
+
+    def clear(self):
+        self.mask = 0
+
+    def copy(self):
+        other = type(self)()
+        other.mask = self.mask
+        return other
+
+    def snapshot(self):
+        return self.mask
+
+    def restore(self, snapshot):
+        self.mask = snapshot
+
+    def count_material(self, material):
+        return (self.mask & MATERIAL_MASKS[material]).bit_count()
+
+    def material_counts(self):
+        return material_counts(self.mask)
+
+
+class CardSetHandCard:
+    # A view of one card in a CardSetHand; visibility lives in the hand's mask
+    __slots__ = ('hand', 'card')
+
+    def __init__(self, hand, card):
+        self.hand = hand
+        self.card = card
+
+    @property
+    def visible(self):
+        return (self.hand.visible_mask >> self.card.id) & 1 == 1
+
+    @visible.setter
+    def visible(self, value):
+        if value:
+            self.hand.visible_mask |= 1 << self.card.id
+        else:
+            self.hand.visible_mask &= ~(1 << self.card.id)
+
+    def __repr__(self):
+        return f'{self.card}{" 👁" if self.visible else ""}'
+
+    def __lt__(self, other):
+        return self.card.id < other.card.id
+
+
+class CardSetHand:
+    __slots__ = ('mask', 'visible_mask')
+
+    def __init__(self, hand_cards=()):
+        self.mask = 0
+        self.visible_mask = 0
+        for c in hand_cards:
+            self.mask |= 1 << c.card.id
+            if c.visible:
+                self.visible_mask |= 1 << c.card.id
+
+    def __len__(self):
+        return self.mask.bit_count()
+
+    def __bool__(self):
+        return self.mask != 0
+
+    def __iter__(self):
+        return (CardSetHandCard(self, c) for c in iter_mask(self.mask))
+
+    def __getitem__(self, i):
+        return CardSetHandCard(self, CARD_BY_ID[nth_bit(self.mask, i).bit_length() - 1])
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def pop(self, i=-1):
+        bit = nth_bit(self.mask, i)
+        self.mask ^= bit
+        visible = bool(self.visible_mask & bit)
+        self.visible_mask &= ~bit
+        return HandCard(CARD_BY_ID[bit.bit_length() - 1], visible)
+
+    def add_to_hand(self, cards):
+        self.mask |= mask_of(cards)
+
+    def hide(self):
+        self.visible_mask = 0
+
+    def copy(self):
+        other = type(self)()
+        other.mask = self.mask
+        other.visible_mask = self.visible_mask
+        return other
+
+    def snapshot(self):
+        return (self.mask, self.visible_mask)
+
+    def restore(self, snapshot):
+        self.mask, self.visible_mask = snapshot
+
+    def remove_indices(self, indices):
+        bits = [nth_bit(self.mask, i) for i in indices]
+        for bit in bits:
+            self.mask &= ~bit
+            self.visible_mask &= ~bit
+        return [CARD_BY_ID[bit.bit_length() - 1] for bit in bits]
+
+    def index_of(self, card):
+        if not (self.mask >> card.id) & 1:
+            raise ValueError(f'{card} not in hand')
+        return (self.mask & ((1 << card.id) - 1)).bit_count()
+
+    def format_hand(self, is_active=False):
+        if is_active:
+            return str(self)
+        else:
+            items = ', '.join(sorted(str(c.card) if c.visible else '?' for c in self))
+            return f'[{items}]'
+
+    @property
+    def revealed_cards(self):
+        return [CardSetHandCard(self, c) for c in iter_mask(self.mask & self.visible_mask)]
+
+    @property
+    def hidden_cards(self):
+        return [CardSetHandCard(self, c) for c in iter_mask(self.mask & ~self.visible_mask)]
+
+    def count_material(self, material):
+        return (self.mask & MATERIAL_MASKS[material]).bit_count()
+
+    def material_counts(self):
+        return material_counts(self.mask)
+
+
+class BitsetBackend:
+    zone = CardSet
+    hand = CardSetHand
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing as mp
+import sys
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from mottainai import Action, Game, State, rewards
+from cardset import BitsetBackend
+from observation import ObservationEncoder
+from rng import CounterRNG
+
+# A reset/step environment around Game for reinforcement learning. An
+# action is a move int, CANCEL or STOP, so the action space is the same in
+# every State and the action mask marks the legal moves of the current
+# decision. Choices of several cards (Tailor, hand reduction, reveals) take
+# one step per card: picked cards leave the mask, STOP ends a choice of a
+# range of cards, and a choice of exactly n cards is applied with its n-th
+# pick. Observations are those of ObservationEncoder for the player to move,
+# and rewards are mottainai.rewards() per seat at the end of the game, zero
+# before.
+
+CANCEL = (max(Action) + 1) << 6
+STOP = CANCEL + 1
+ACTION_COUNT = STOP + 1
+
+
+def most_picks(game):
+    # How many cards the pending decision takes at most. A Tailor with a
+    # full waiting area takes none, and only STOP is offered
+    n = game.number_of_moves_to_choose
+    return min(n[1], len(game.moves)) if isinstance(n, tuple) else n
+
+
+class MottainaiEnv:
+    # observation and mask are the arrays reset() and step() write into and
+    # return, by default owned by the env. They are overwritten by the next
+    # call
+    def __init__(self, player_count=2, seed=None, backend=BitsetBackend, observation=None, mask=None):
+        self.player_count = player_count
+        self.backend = backend
+        self.rng = CounterRNG(seed)
+        self.encoder = ObservationEncoder(player_count, batch_size=1)
+        self.observation_size = self.encoder.size
+        self.action_count = ACTION_COUNT
+        self.observation = observation if observation is not None else np.zeros(self.observation_size, np.float32)
+        self.mask = mask if mask is not None else np.zeros(ACTION_COUNT, bool)
+        self.no_reward = np.zeros(player_count, np.float32)
+        self.game = None
+        self.picked = []
+
+    def reset(self, seed=None):
+        self.new_game(seed)
+        return self.observe(), self.info()
+
+    def step(self, action):
+        reward, terminated = self.act(action)
+        return self.observe(), reward, terminated, False, self.info()
+
+    def new_game(self, seed=None):
+        if seed is not None:
+            self.rng = CounterRNG(seed)
+        self.game = Game(verbose=False, rng=CounterRNG(self.rng.getrandbits(64)), backend=self.backend)
+        self.game.deal(self.player_count)
+        self.picked = []
+        self.game.step_until_decision()
+        self.update_mask()
+
+    def act(self, action):
+        # Plays an action without encoding an observation. Returns the
+        # rewards and whether the game is over
+        if not self.mask[action]:
+            raise ValueError(f'Illegal action {action} in {self.game.state}')
+        game = self.game
+        n = game.number_of_moves_to_choose
+        if action == CANCEL:
+            moves = -1
+        elif action == STOP:
+            moves = self.picked
+        elif n == 1:
+            moves = game.moves.index(action)
+        else:
+            self.picked.append(game.moves.index(action))
+            moves = self.picked if len(self.picked) == most_picks(game) else None
+        if moves is not None:
+            self.picked = []
+            game.apply(moves)
+            game.step_until_decision()
+        self.update_mask()
+        if game.state == State.GAME_OVER:
+            return np.array(rewards(game), np.float32), True
+        return self.no_reward, False
+
+    def update_mask(self):
+        mask = self.mask
+        mask[:] = False
+        game = self.game
+        if game.state == State.GAME_OVER:
+            return
+        picked = self.picked
+        if len(picked) < most_picks(game):
+            for i, move in enumerate(game.moves):
+                if i not in picked:
+                    mask[move] = True
+        if game.allow_cancel and not picked:
+            mask[CANCEL] = True
+        n = game.number_of_moves_to_choose
+        if isinstance(n, tuple) and len(picked) >= n[0]:
+            mask[STOP] = True
+
+    def observe(self):
+        self.encoder.encode([self.game], self.observation.reshape(1, -1))
+        return self.observation
+
+    def info(self):
+        return {'player': self.game.active_player_ix, 'state': self.game.state, 'action_mask': self.mask}
+
+
+# VectorEnv runs count envs split over worker processes. Observations,
+# masks, rewards and actions live in one shared memory block; the pipe to
+# each worker only carries a one byte command and its acknowledgement.
+
+def shared_layout(count, player_count, observation_size):
+    # (name, dtype, shape, offset) of each array and the block size
+    fields = [
+        ('observations', np.float32, (count, observation_size)),
+        ('masks', np.bool_, (count, ACTION_COUNT)),
+        ('rewards', np.float32, (count, player_count)),
+        ('terminated', np.bool_, (count,)),
+        ('players', np.int64, (count,)),
+        ('actions', np.int64, (count,)),
+    ]
+    layout = []
+    offset = 0
+    for name, dtype, shape in fields:
+        layout.append((name, dtype, shape, offset))
+        size = np.dtype(dtype).itemsize * int(np.prod(shape))
+        offset += (size + 63) // 64 * 64
+    return layout, offset
+
+
+def shared_arrays(buffer, layout):
+    return {
+        name: np.ndarray(shape, dtype, buffer=buffer, offset=offset)
+        for name, dtype, shape, offset in layout
+    }
+
+
+def worker(conn, shm_name, layout, start, stop, player_count, seed):
+    # Replies to each command with b'', or with the error that ended the
+    # worker, so the parent need not only find the pipe closed
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        serve_envs(conn, shm.buf, layout, start, stop, player_count, seed)
+    except Exception as e:
+        conn.send_bytes(traceback.format_exception_only(type(e), e)[-1].strip().encode())
+    finally:
+        shm.close()
+
+
+def serve_envs(conn, buffer, layout, start, stop, player_count, seed):
+    arrays = shared_arrays(buffer, layout)
+    observations = arrays['observations'][start:stop]
+    masks = arrays['masks']
+    rewards = arrays['rewards']
+    terminated = arrays['terminated']
+    players = arrays['players']
+    actions = arrays['actions']
+    envs = [MottainaiEnv(player_count, f'{seed}:{i}', mask=masks[i]) for i in range(start, stop)]
+    # One encoder for all of this worker's games is much cheaper than one
+    # encode() call per env
+    encoder = ObservationEncoder(player_count, batch_size=len(envs))
+    while True:
+        command = conn.recv_bytes()
+        if command == b'c':
+            return
+        for i, env in enumerate(envs, start):
+            if command == b'r':
+                env.new_game()
+                rewards[i] = 0
+                terminated[i] = False
+            else:
+                rewards[i], terminated[i] = env.act(actions[i])
+                if terminated[i]:
+                    env.new_game()
+            players[i] = env.game.active_player_ix
+        encoder.encode([env.game for env in envs], observations)
+        conn.send_bytes(b'')
+
+
+class VectorEnv:
+    # reset() and step() return views of the shared arrays, which the next
+    # call overwrites and which must not be used once closed. A game that
+    # ends is reset at once: its step returns the final rewards with
+    # terminated set, and the first observation of the next game. A worker
+    # error closes the VectorEnv and is raised as a RuntimeError
+    def __init__(self, count, player_count=2, processes=None, seed=0, close_timeout=5):
+        processes = min(processes or mp.cpu_count(), count)
+        self.count = count
+        self.close_timeout = close_timeout
+        self.player_count = player_count
+        self.observation_size = ObservationEncoder(player_count, batch_size=1).size
+        self.action_count = ACTION_COUNT
+        layout, size = shared_layout(count, player_count, self.observation_size)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.arrays = shared_arrays(self.shm.buf, layout)
+        self.truncated = np.zeros(count, np.bool_)
+        self.conns = []
+        self.workers = []
+        try:
+            for w in range(processes):
+                start = count * w // processes
+                stop = count * (w + 1) // processes
+                conn, child_conn = mp.Pipe()
+                process = mp.Process(
+                    target=worker, args=(child_conn, self.shm.name, layout, start, stop, player_count, seed),
+                    daemon=True)
+                process.start()
+                self.conns.append(conn)
+                self.workers.append(process)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def run(self, command):
+        try:
+            for conn in self.conns:
+                conn.send_bytes(command)
+            replies = [conn.recv_bytes() for conn in self.conns]
+        except BaseException:
+            self.close()
+            raise
+        errors = [reply.decode() for reply in replies if reply]
+        if errors:
+            self.close()
+            raise RuntimeError(f'VectorEnv worker failed: {errors[0]}')
+
+    def info(self):
+        return {'player': self.arrays['players'], 'action_mask': self.arrays['masks']}
+
+    def reset(self):
+        self.run(b'r')
+        return self.arrays['observations'], self.info()
+
+    def step(self, actions):
+        self.arrays['actions'][:] = actions
+        self.run(b's')
+        return (self.arrays['observations'], self.arrays['rewards'], self.arrays['terminated'],
+                self.truncated, self.info())
+
+    def close(self):
+        if self.shm is None:
+            return
+        try:
+            for conn in self.conns:
+                try:
+                    conn.send_bytes(b'c')
+                except OSError:
+                    # Its worker has already exited
+                    pass
+            # A worker wedged mid-step would never read b'c', so workers still
+            # running after close_timeout seconds are terminated
+            deadline = time.monotonic() + self.close_timeout
+            for process in self.workers:
+                process.join(max(0, deadline - time.monotonic()))
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+        finally:
+            self.arrays = None
+            shm, self.shm = self.shm, None
+            shm.close()
+            shm.unlink()
+
+
+def random_actions(rng, masks):
+    # A uniformly random legal action per row
+    return np.argmax(rng.random(masks.shape) * masks, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure vectorized environment throughput with random actions')
+    parser.add_argument('-n', '--envs', type=int, default=256)
+    parser.add_argument('-j', '--processes', type=int, default=mp.cpu_count())
+    parser.add_argument('-p', '--players', type=int, default=2)
+    parser.add_argument('-t', '--steps', type=int, default=1000)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    with VectorEnv(args.envs, args.players, args.processes, args.seed) as venv:
+        _, info = venv.reset()
+        games = 0
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            _, _, terminated, _, info = venv.step(random_actions(rng, info['action_mask']))
+            games += int(terminated.sum())
+        elapsed = time.perf_counter() - start
+    steps = args.envs * args.steps
+    print(f'{steps} steps in {elapsed:.2f}s - {steps / elapsed:.0f} steps/s, {games} games finished')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,659 @@
+#!/usr/bin/env python3
+
+import argparse
+import ast
+import os
+import sys
+import time
+import traceback
+from collections import Counter, namedtuple
+from multiprocessing import Pool
+
+from mottainai import (
+    CARD_BY_ID, CARDS, COUNTED_ZONES, COUNTS_STRIDE, MATERIALS, PLAYER_ZONES, STEP_FIELDS, WORKS_CAPS,
+    WORKS_STRIDES, Action, Game, HandCard, ListBackend, State, get_step_fields, move_action,
+)
+from canonical import canonical_key, canonical_move, material_id
+from cardset import MATERIAL_MASKS, BitsetBackend, mask_of
+from env import MottainaiEnv
+from replay import GameRecord, write_record
+from rng import CounterRNG
+from tournament import game_seed
+from zobrist import HashedCardSet, ZobristBackend, attach, game_hash, rehash
+
+# Plays games with random legal decisions, a share of them edge cases
+# (cancels, the fewest and most cards a choice allows, the first and last
+# option), and checks the invariants below after every step. A failure is
+# an exception or a broken invariant. It is reproduced from the game's seed
+# and its list of decisions, which is then shrunk: decisions after the
+# failure are dropped, and every decision that can be replaced by the
+# default one (see default_choice) while the game still fails the same way
+# is replaced. What remains is the seed and the few decisions that matter.
+
+BACKENDS = {
+    'list': ListBackend,
+    'bitset': BitsetBackend,
+    'zobrist': ZobristBackend,
+}
+ALL_CARDS = mask_of(CARDS)
+# Card masks by material id, in the order of a run of Player.zone_counts
+COUNT_MASKS = [0] + [MATERIAL_MASKS[m] for m in MATERIALS]
+# States between turns, when no task is being performed
+TURN_STATES = {
+    State.CHECK_HAND_SIZE, State.REDUCE_HAND, State.MORNING_EFFECTS, State.DISCARD_OLD_TASK,
+    State.CHOOSE_NEW_TASK, State.NIGHT_EFFECTS, State.DRAW_WAITING_AREA,
+}
+# next_states holds where the current task returns to, and PERFORM_TASK
+# while one of its actions is performed
+STACK_DEPTHS = {
+    State.PERFORM_OPPONENT_TASK: 0,
+    State.PERFORM_OWN_TASK: 0,
+    State.PERFORM_TASK: 1,
+}
+# The zone each move's card must be in, by action
+MOVE_ZONES = {
+    Action.TASK: 'hand',
+    Action.RETURN: 'hand',
+    Action.SMITH_WORK: 'hand',
+    Action.CRAFT_WORK: 'hand',
+    Action.REVEAL: 'hand',
+    Action.SELL: 'craft_bench',
+    Action.HIRE: 'floor',
+    Action.COLLECT: 'floor',
+}
+
+# Each card mapped to the next card of its material, to relabel positions
+# without changing what they are
+RELABEL = {}
+for material in MATERIALS:
+    same = [c for c in CARDS if c.material is material]
+    RELABEL.update(zip(same, same[1:] + same[:1]))
+# Zones that signature() gives as card ids
+ID_ZONES = ('floor',) + PLAYER_ZONES[1:]
+# Step fields that are not part of a position: a step's input, values
+# worked out again before they are next read, and turn_number, which no rule
+# reads (see canonical.py)
+SCRATCH_FIELDS = {'submitted_moves', 'completeable_smith_works', 'completeable_craft_works', 'turn_number'}
+
+# Games that have not ended after this many steps are failures
+MAX_STEPS = 100000
+
+Failure = namedtuple('Failure', 'kind state message step')
+FuzzResult = namedtuple('FuzzResult', 'index seed players backend failure decisions record')
+
+
+# Each check returns a description of what is wrong, or None
+
+def check_cards(game):
+    # Every card is in exactly one place
+    zones = [game.deck.cards[game.deck.top:], game.floor]
+    for p in game.players:
+        zones.extend(getattr(p, zone) for zone in PLAYER_ZONES)
+        zones.append([c for c in (p.task, p.initial_task) if c is not None])
+    if game.completed_work is not None:
+        zones.append([game.completed_work])
+    union = 0
+    count = 0
+    for zone in zones:
+        union |= zone.mask if hasattr(zone, 'mask') else mask_of(zone)
+        count += len(zone)
+    if union == ALL_CARDS and count == len(CARDS):
+        return None
+    missing = [CARD_BY_ID[i] for i in range(64) if (ALL_CARDS & ~union) >> i & 1]
+    # Hands hold HandCards
+    placed = Counter(getattr(c, 'card', c) for zone in zones for c in zone)
+    repeated = sorted(c for c, n in placed.items() if n > 1)
+    return f'{count} cards placed, missing {missing}, repeated {repeated}'
+
+
+def check_next_states(game):
+    # The states a task returns to, and the opponents whose tasks are left
+    # while opponents' tasks are performed
+    stack = game.next_states
+    state = game.state
+    if state == State.GAME_OVER:
+        return None
+    if state in TURN_STATES:
+        if game.opponents_with_tasks is not None:
+            return 'opponents_with_tasks left set between turns'
+        depth = 0
+    else:
+        depth = STACK_DEPTHS.get(state, 2)
+    if len(stack) != depth:
+        return f'{stack} pending in {state.name}, expected {depth} states'
+    if stack:
+        task_return = State.PERFORM_OPPONENT_TASK if game.current_task_is_of_opponent else State.NIGHT_EFFECTS
+        if stack[0] != task_return or stack[1:] not in ([], [State.PERFORM_TASK]):
+            return f'unexpected stack {stack}'
+        if (stack[0] == State.PERFORM_OPPONENT_TASK) != (game.opponents_with_tasks is not None):
+            return f'opponents_with_tasks is {game.opponents_with_tasks} with stack {stack}'
+    return None
+
+
+def check_hands(game):
+    for i, p in enumerate(game.players):
+        hand = p.hand
+        ids = [c.card.id for c in hand]
+        if ids != sorted(set(ids)):
+            return f'player {i} hand out of order or repeated: {ids}'
+        revealed = mask_of(c.card for c in hand.revealed_cards)
+        hidden = mask_of(c.card for c in hand.hidden_cards)
+        if revealed != hand.visible_mask or revealed & hidden or revealed | hidden != hand.mask:
+            return f'player {i} revealed {revealed:#x} and hidden {hidden:#x} do not split hand {hand.mask:#x}'
+    return None
+
+
+def check_counts(game):
+    # zone_counts and works_index against a recount of the zones
+    for i, p in enumerate(game.players):
+        zone_masks = [getattr(p, zone).mask for zone in COUNTED_ZONES]
+        counts = [(zone_mask & mask).bit_count() for zone_mask in zone_masks for mask in COUNT_MASKS]
+        if counts != p.zone_counts:
+            count_ix = next(j for j, (a, b) in enumerate(zip(counts, p.zone_counts)) if a != b)
+            zone, material_id = divmod(count_ix, COUNTS_STRIDE)
+            return (f'player {i} counts {p.zone_counts[count_ix]} {MATERIALS[material_id - 1].name} '
+                    f'in {COUNTED_ZONES[zone]}, holds {counts[count_ix]}')
+        works_index = sum(min(counts[count_ix], cap) * WORKS_STRIDES[count_ix] for count_ix, cap in WORKS_CAPS)
+        if p.works_index != works_index:
+            return f'player {i} works_index {p.works_index}, counts give {works_index}'
+    return None
+
+
+def check_decision(game):
+    # The pending decision can be made and its cards are where it says
+    moves = game.moves
+    if not moves:
+        return None
+    n = game.number_of_moves_to_choose
+    low, high = n if isinstance(n, tuple) else (n, n)
+    if not 0 <= low <= high or low > len(moves):
+        return f'cannot choose {n} of {len(moves)} moves'
+    if len(set(moves)) != len(moves):
+        return f'repeated moves {moves}'
+    player = game.active_player
+    for move in moves:
+        zone_name = MOVE_ZONES.get(move_action(move))
+        if zone_name is None:
+            continue
+        zone = game.floor if zone_name == 'floor' else getattr(player, zone_name)
+        if not zone.mask >> (move & 63) & 1:
+            return f'{Action(move_action(move)).name} of {CARD_BY_ID[move & 63]}, which is not in {zone_name}'
+        if move_action(move) == Action.REVEAL and player.hand.visible_mask >> (move & 63) & 1:
+            return f'reveal of the already revealed {CARD_BY_ID[move & 63]}'
+    return None
+
+
+def check_hash(game):
+    # The incrementally kept Zobrist hash against one from scratch
+    if not isinstance(game.floor, HashedCardSet):
+        return None
+    kept, fresh = game_hash(game), rehash(game)
+    if kept != fresh:
+        return f'kept hash {kept:016x}, recomputed {fresh:016x}'
+    return None
+
+
+def signature(game):
+    # Everything a step can change, by name, with cards as ids in zone order
+    parts = list(zip(STEP_FIELDS, get_step_fields(game)))
+    parts += [
+        ('next_states', game.next_states[:]),
+        ('opponents_with_tasks', None if game.opponents_with_tasks is None else
+            [game.players.index(p) for p in game.opponents_with_tasks]),
+        ('floor', [c.id for c in game.floor]),
+        ('deck', (game.deck.cards[game.deck.top:], game.deck.exhausted)),
+    ]
+    for i, p in enumerate(game.players):
+        parts += [
+            (f'player {i} tasks', (p.task, p.initial_task)),
+            (f'player {i} hand', [(c.card.id, c.visible) for c in p.hand]),
+            (f'player {i} counts', (tuple(p.zone_counts), p.works_index)),
+        ]
+        parts += [(f'player {i} {zone}', [c.id for c in getattr(p, zone)]) for zone in PLAYER_ZONES[1:]]
+    return parts
+
+
+def changed(before, after):
+    return [name for (name, a), (_, b) in zip(before, after) if a != b]
+
+
+def check_undo(game):
+    # On a clone: a step undone leaves the position as it was, and redone
+    # leaves it as the step did. The game itself must not change
+    if game.state == State.GAME_OVER:
+        return None
+    before = signature(game)
+    clone = game.clone()
+    clone.undo_log = []
+    moves = default_choice(clone) if clone.moves else None
+    clone.apply(moves)
+    after = signature(clone)
+    clone.undo()
+    diff = changed(before, signature(clone))
+    if diff:
+        return f'undo of {moves} in {game.state.name} left {", ".join(diff)} changed'
+    clone.apply(moves)
+    diff = changed(after, signature(clone))
+    if diff:
+        return f'{moves} redone in {game.state.name} changed {", ".join(diff)} differently'
+    diff = changed(before, signature(game))
+    if diff:
+        return f'{moves} applied to a clone in {game.state.name} changed {", ".join(diff)} of the game'
+    return None
+
+
+def relabel(game):
+    # A clone with every card replaced by its RELABEL card
+    other = game.clone()
+    other.floor = type(game.floor)(RELABEL[c] for c in game.floor)
+    for p, q in zip(game.players, other.players):
+        for zone in PLAYER_ZONES[1:]:
+            setattr(q, zone, type(getattr(p, zone))(RELABEL[c] for c in getattr(p, zone)))
+        hand = sorted((HandCard(RELABEL[c.card], c.visible) for c in p.hand), key=lambda c: c.card.id)
+        q.hand = type(p.hand)(hand)
+        q.task = RELABEL.get(p.task)
+        q.initial_task = RELABEL.get(p.initial_task)
+    deck = other.deck
+    deck.cards[deck.top:] = [RELABEL[c] for c in deck.cards[deck.top:]]
+    other.current_task_to_perform = RELABEL.get(game.current_task_to_perform)
+    other.completed_work = RELABEL.get(game.completed_work)
+    if game.moves is not None:
+        other.moves = [m - (m & 63) + RELABEL[CARD_BY_ID[m & 63]].id if m & 63 else m for m in game.moves]
+    return other
+
+
+def material_signature(game):
+    # signature() with cards as their materials and zones as multisets:
+    # what canonical_key() must tell apart, no more and no less
+    parts = []
+    for name, value in signature(game):
+        field = name.rsplit(' ', 1)[-1]
+        if field in SCRATCH_FIELDS:
+            continue
+        if field == 'moves':
+            value = None if value is None else tuple(sorted(canonical_move(m) for m in value))
+        elif field in ID_ZONES:
+            value = tuple(sorted(CARD_BY_ID[i].material.id for i in value))
+        elif field == 'hand':
+            value = tuple(sorted((CARD_BY_ID[i].material.id, visible) for i, visible in value))
+        elif field == 'deck':
+            value = tuple(sorted(c.material.id for c in value[0])), value[1]
+        elif field == 'tasks':
+            value = tuple(material_id(c) for c in value)
+        elif field in ('current_task_to_perform', 'completed_work'):
+            value = material_id(value)
+        elif isinstance(value, list):
+            value = tuple(value)
+        parts.append((name, value))
+    return tuple(parts)
+
+
+class KeyHistory:
+    # The material_signature() first seen with each canonical_key() in the
+    # game being checked, as an EvaluationCache would hold them
+    def __init__(self):
+        self.game = None
+        self.signatures = {}
+
+    def first(self, game, key, signature):
+        if game is not self.game:
+            self.game = game
+            self.signatures = {}
+        return self.signatures.setdefault(key, signature)
+
+
+key_history = KeyHistory()
+
+
+def check_canonical(game):
+    # canonical_key() against material_signature() for the position, its
+    # relabelled twin, the position after each single decision and every
+    # position seen before in the game: keys must be equal exactly when the
+    # positions are the same but for which card of a material is where, or
+    # an EvaluationCache would merge positions that differ or keep apart
+    # ones that do not
+    if game.state == State.GAME_OVER:
+        return None
+    positions = [('position', game), ('relabelled', relabel(game))]
+    if game.moves and game.number_of_moves_to_choose == 1:
+        choices = list(range(len(game.moves))) + ([-1] if game.allow_cancel else [])
+        for i in choices:
+            after = game.clone()
+            after.apply(i)
+            positions.append((f'after {i}', after))
+    by_signature = {}
+    for name, position in positions:
+        key = canonical_key(position)
+        signature = material_signature(position)
+        first = key_history.first(game, key, signature)
+        if first != signature:
+            return f'{name} in {game.state.name} shares a key with a position seen before that differs in ' \
+                f'{", ".join(changed(first, signature))}'
+        other = by_signature.setdefault(signature, (name, key))
+        if other[1] != key:
+            return f'{other[0]} and {name} in {game.state.name} have different keys'
+    return None
+
+
+CHECKS = {
+    'cards': check_cards,
+    'next_states': check_next_states,
+    'hands': check_hands,
+    'counts': check_counts,
+    'decision': check_decision,
+    'hash': check_hash,
+    'undo': check_undo,
+    'canonical': check_canonical,
+}
+# Checks that play steps on clones after every step cost several times what
+# the game does, so they only run when named with -k
+SLOW_CHECKS = {'undo', 'canonical'}
+DEFAULT_CHECKS = {name: check for name, check in CHECKS.items() if name not in SLOW_CHECKS}
+
+
+def default_choice(game):
+    # The first option, or the fewest first options a choice of several
+    # allows
+    n = game.number_of_moves_to_choose
+    if n == 1:
+        return 0
+    return list(range(n[0] if isinstance(n, tuple) else n))
+
+
+def fuzz_choice(game, rng, edge_rate):
+    options = len(game.moves)
+    n = game.number_of_moves_to_choose
+    edge = rng.random() < edge_rate
+    if edge and game.allow_cancel and rng.random() < 0.5:
+        return -1
+    if n == 1:
+        return rng.choice((0, options - 1)) if edge else rng.randrange(options)
+    if isinstance(n, tuple):
+        low, high = n[0], min(n[1], options)
+        count = rng.choice((low, high)) if edge else rng.randint(low, high)
+    else:
+        count = n
+    return rng.sample(range(options), count)
+
+
+def valid_choice(game, moves):
+    # Whether a recorded decision still fits the pending one
+    n = game.number_of_moves_to_choose
+    options = len(game.moves)
+    if moves == -1:
+        return game.allow_cancel
+    if isinstance(moves, int):
+        return n == 1 and 0 <= moves < options
+    if n == 1 or len(set(moves)) != len(moves) or not all(0 <= i < options for i in moves):
+        return False
+    low, high = n if isinstance(n, tuple) else (n, n)
+    return low <= len(moves) <= high
+
+
+class InvalidChoice(Exception):
+    pass
+
+
+class CheckedGame(Game):
+    # Game takes decisions on trust; this one first checks that each fits
+    # the pending choice
+    __slots__ = ()
+
+    def apply(self, moves):
+        if self.moves and not valid_choice(self, moves):
+            raise InvalidChoice(f'{moves} for a choice of {self.number_of_moves_to_choose} of {len(self.moves)}')
+        Game.apply(self, moves)
+
+
+def play(seed, player_count, backend=ListBackend, rng=None, decisions=None, edge_rate=0.2, record=False,
+         coverage=None, checks=DEFAULT_CHECKS):
+    # Plays one game from seed, checking every invariant after every step.
+    # Decisions are taken from the decisions list while it lasts, None or
+    # one that does not fit the position meaning default_choice(), and then
+    # from fuzz_choice() with rng, or default_choice() without. Returns the
+    # decisions made, the failure or None and the game
+    game = CheckedGame(verbose=False, rng=CounterRNG(seed), backend=backend)
+    if record:
+        game.record = GameRecord()
+    made = []
+    step = 0
+    state = None
+    try:
+        game.deal(player_count)
+        if backend is ZobristBackend:
+            attach(game)
+        while game.state != State.GAME_OVER:
+            if coverage is not None:
+                coverage[game.state.value] += 1
+            moves = None
+            if game.moves:
+                i = len(made)
+                if decisions is not None and i < len(decisions):
+                    moves = decisions[i]
+                    if moves is None or not valid_choice(game, moves):
+                        moves = default_choice(game)
+                elif rng is not None:
+                    moves = fuzz_choice(game, rng, edge_rate)
+                else:
+                    moves = default_choice(game)
+                made.append(moves)
+            state = game.state
+            game.apply(moves)
+            step += 1
+            if step == MAX_STEPS:
+                return made, Failure('step_limit', state, f'no end after {step} steps', step), game
+            for kind, check in checks.items():
+                message = check(game)
+                if message is not None:
+                    return made, Failure(kind, state, message, step), game
+    except Exception as e:
+        message = traceback.format_exception_only(type(e), e)[-1].strip()
+        # step counts the apply() calls that completed
+        return made, Failure(type(e).__name__, state, message, step + 1), game
+    return made, None, game
+
+
+def play_env(seed, player_count, backend, rng, coverage=None, checks=DEFAULT_CHECKS):
+    # Plays one game through MottainaiEnv with random actions among those
+    # its mask allows, checking the invariants after every action. Returns
+    # the actions taken, the failure or None and the game
+    env = MottainaiEnv(player_count, seed, backend)
+    env.new_game()
+    game = env.game
+    if backend is ZobristBackend:
+        attach(game)
+    game.__class__ = CheckedGame
+    actions = []
+    state = game.state
+    try:
+        while game.state != State.GAME_OVER:
+            if coverage is not None:
+                coverage[game.state.value] += 1
+            legal = env.mask.nonzero()[0]
+            action = int(legal[rng.randrange(len(legal))])
+            actions.append(action)
+            state = game.state
+            env.act(action)
+            if not env.picked:
+                for kind, check in checks.items():
+                    message = check(game)
+                    if message is not None:
+                        return actions, Failure(kind, state, message, len(actions)), game
+    except Exception as e:
+        message = traceback.format_exception_only(type(e), e)[-1].strip()
+        return actions, Failure(type(e).__name__, state, message, len(actions)), game
+    return actions, None, game
+
+
+def same_failure(a, b):
+    return b is not None and (a.kind, a.state) == (b.kind, b.state)
+
+
+def failure_checks(failure, checks):
+    # Only the check that failed, which is all that replays need to run. An
+    # exception may come from any of the checks
+    return {failure.kind: checks[failure.kind]} if failure.kind in checks else checks
+
+
+def shrink(seed, player_count, backend, decisions, failure, checks=DEFAULT_CHECKS):
+    # Replaces decisions with None, meaning the default choice, as long as
+    # the game still fails the same way, and drops trailing Nones
+    decisions = list(decisions)
+    checks = failure_checks(failure, checks)
+
+    def fails(candidate):
+        return same_failure(failure, play(seed, player_count, backend, decisions=candidate, checks=checks)[1])
+
+    # Defaults from some point on, found by halving, then one at a time from
+    # the end, as later decisions depend on earlier ones
+    keep = len(decisions)
+    span = keep // 2
+    while span:
+        if span <= keep and fails(decisions[:keep - span]):
+            keep -= span
+        else:
+            span //= 2
+    decisions = decisions[:keep]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(len(decisions))):
+            if decisions[i] is None:
+                continue
+            candidate = decisions[:i] + [None] + decisions[i + 1:]
+            if fails(candidate):
+                decisions = candidate
+                changed = True
+    while decisions and decisions[-1] is None:
+        decisions.pop()
+    return decisions
+
+
+def fuzz_game(fuzz_seed, index, player_counts, backend_names, edge_rate, check_names=tuple(DEFAULT_CHECKS),
+              coverage=None, env=False):
+    seed = game_seed(fuzz_seed, index)
+    player_count = player_counts[index % len(player_counts)]
+    backend_name = backend_names[index // len(player_counts) % len(backend_names)]
+    backend = BACKENDS[backend_name]
+    checks = {name: CHECKS[name] for name in check_names}
+    if env:
+        # Env failures are reported with their actions, unshrunk
+        actions, failure, game = play_env(seed, player_count, backend, CounterRNG(seed).fork(1), coverage, checks)
+        if failure is None:
+            return game.turn_number, None
+        return game.turn_number, FuzzResult(index, seed, player_count, backend_name, failure, actions, None)
+    decisions, failure, game = play(seed, player_count, backend, CounterRNG(seed).fork(1), edge_rate=edge_rate,
+                                    coverage=coverage, checks=checks)
+    if failure is None:
+        return game.turn_number, None
+    decisions = shrink(seed, player_count, backend, decisions, failure, checks)
+    # The shrunk game once more, recorded for replay.py
+    _, failure, game = play(seed, player_count, backend, decisions=decisions, record=True,
+                            checks=failure_checks(failure, checks))
+    return game.turn_number, FuzzResult(index, seed, player_count, backend_name, failure, decisions,
+                                        game.record.to_bytes())
+
+
+def fuzz_chunk(args):
+    fuzz_seed, start, stop, player_counts, backend_names, edge_rate, check_names, env = args
+    coverage = [0] * (max(s.value for s in State) + 1)
+    turns = 0
+    failures = []
+    for index in range(start, stop):
+        game_turns, result = fuzz_game(fuzz_seed, index, player_counts, backend_names, edge_rate, check_names,
+                                       coverage, env)
+        turns += game_turns
+        if result is not None:
+            failures.append(result)
+    return stop - start, turns, coverage, failures
+
+
+def run_fuzz(games, player_counts=(1, 2, 3, 4), backend_names=tuple(BACKENDS), seed=0, edge_rate=0.2,
+             check_names=tuple(DEFAULT_CHECKS), processes=None, chunk_size=256, env=False):
+    # Yields fuzz_chunk() results as chunks finish
+    chunks = [
+        (seed, start, min(start + chunk_size, games), player_counts, backend_names, edge_rate, check_names, env)
+        for start in range(0, games, chunk_size)
+    ]
+    if processes == 1:
+        for chunk in chunks:
+            yield fuzz_chunk(chunk)
+        return
+    with Pool(processes) as pool:
+        yield from pool.imap_unordered(fuzz_chunk, chunks)
+
+
+def format_failure(result):
+    f = result.failure
+    return '\n'.join([
+        f'Game {result.index}: {f.kind} at step {f.step} in {f.state.name if f.state else "deal"}: {f.message}',
+        f'\tseed {result.seed}, {result.players} players, {result.backend} backend',
+        f'\tdecisions {result.decisions}',
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play random games and check invariants after every step')
+    parser.add_argument('-n', '--games', type=int, default=10000)
+    parser.add_argument('-p', '--players', type=int, nargs='+', default=[1, 2, 3, 4])
+    parser.add_argument('-b', '--backend', choices=sorted(BACKENDS), nargs='+', default=sorted(BACKENDS))
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-e', '--edge-rate', type=float, default=0.2, help='share of edge case decisions')
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count())
+    parser.add_argument('-c', '--chunk-size', type=int, default=256)
+    parser.add_argument('-k', '--check', choices=sorted(CHECKS), nargs='+', default=sorted(DEFAULT_CHECKS),
+                        help=f'invariants to check, all but the slow {", ".join(sorted(SLOW_CHECKS))} by default')
+    parser.add_argument('--env', action='store_true',
+                        help='play through MottainaiEnv with random actions its mask allows; -e does not apply')
+    parser.add_argument('-m', '--max-failures', type=int, default=10, help='stop after this many failures')
+    parser.add_argument('-r', '--record',
+                        help='write the shrunk failing games to a record file for replay.py, which needs the -b '
+                             'backend they were found with')
+    parser.add_argument('--repro', nargs=3, metavar=('SEED', 'PLAYERS', 'DECISIONS'),
+                        help='replay one failure, DECISIONS as printed, with the first -b backend')
+    args = parser.parse_args()
+
+    if args.repro is not None:
+        seed, player_count, decisions = int(args.repro[0]), int(args.repro[1]), ast.literal_eval(args.repro[2])
+        _, failure, game = play(seed, player_count, BACKENDS[args.backend[0]], decisions=decisions,
+                                checks={name: CHECKS[name] for name in args.check})
+        game.verbose = True
+        game.print_state()
+        print(failure if failure is not None else 'No failure')
+        return 1 if failure is not None else 0
+
+    records = open(args.record, 'wb') if args.record else None
+    coverage = [0] * (max(s.value for s in State) + 1)
+    games = turns = 0
+    failures = []
+    start = time.perf_counter()
+    for chunk_games, chunk_turns, chunk_coverage, chunk_failures in run_fuzz(
+            args.games, args.players, args.backend, args.seed, args.edge_rate, args.check, args.processes,
+            args.chunk_size, args.env):
+        games += chunk_games
+        turns += chunk_turns
+        coverage = [a + b for a, b in zip(coverage, chunk_coverage)]
+        for result in chunk_failures[:args.max_failures - len(failures)]:
+            print(format_failure(result))
+            if records and result.record is not None:
+                write_record(records, result.record)
+            failures.append(result)
+        if len(failures) >= args.max_failures:
+            break
+    elapsed = time.perf_counter() - start
+    if records:
+        records.close()
+
+    steps = sum(coverage)
+    print(f'{games} games, {turns} turns, {steps} steps in {elapsed:.2f}s - {steps / elapsed:.0f} steps/s, '
+          f'{len(failures)} failures')
+    # The env only reaches steps with a decision
+    unreached = [s.name for s in State if s != State.GAME_OVER and not coverage[s.value]]
+    if unreached and not args.env:
+        print(f'Never reached: {", ".join(unreached)}')
+    if failures:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,457 @@
+import argparse
+import math
+import random
+import sys
+import threading
+import time
+from itertools import combinations
+
+from mottainai import CRAFT_BENCH, HELPERS, MATERIALS, Game, HumanAgent, State, rewards
+from agents import RandomAgent
+
+# Multi-card choices (Tailor, hand reduction, reveals) can have hundreds of
+# subsets; beyond this many only a random sample is offered per iteration
+MAX_COMBINATIONS = 32
+
+
+def legal_moves(game, rng):
+    # Returns (key, moves) pairs where moves is what apply() expects. Move
+    # ints name cards and actions rather than positions, so a key means the
+    # same thing in every determinization
+    legal = game.legal_moves()
+    options = len(legal)
+    n = game.number_of_moves_to_choose
+    if n == 1:
+        return [(legal[i], i) for i in range(options)]
+
+    sizes = range(n[0], min(n[1], options) + 1) if isinstance(n, tuple) else [n]
+    total = sum(math.comb(options, k) for k in sizes)
+    if total <= MAX_COMBINATIONS:
+        subsets = [c for k in sizes for c in combinations(range(options), k)]
+    else:
+        sizes = list(sizes)
+        subsets = set()
+        while len(subsets) < MAX_COMBINATIONS:
+            k = rng.choice(sizes)
+            subsets.add(tuple(sorted(rng.sample(range(options), k))))
+    return [(frozenset(legal[i] for i in s), list(s)) for s in subsets]
+
+
+def move_key(game, moves):
+    # The legal_moves() key of what apply() is about to be given, None for
+    # a cancel
+    if isinstance(moves, int):
+        return None if moves == -1 else game.moves[moves]
+    return frozenset(game.moves[i] for i in moves)
+
+
+def determinize(game, observer_ix, rng):
+    # Clone the game and reshuffle everything the observer cannot see: the
+    # deck order and the opponents' hidden hand cards, hidden initial tasks
+    # and waiting areas. Revealed hand cards stay where they are.
+    g = game.clone()
+    g.verbose = False
+    unknown = g.deck.cards[g.deck.top:]
+    opponents = [p for i, p in enumerate(g.players) if i != observer_ix]
+    hidden_counts = []
+    for p in opponents:
+        hidden = [i for i, c in enumerate(p.hand) if not c.visible]
+        hidden_counts.append(len(hidden))
+        unknown.extend(p.remove_hand_indices(hidden))
+        if p.initial_task:
+            unknown.append(p.initial_task)
+        unknown.extend(p.waiting_area)
+    rng.shuffle(unknown)
+
+    for p, hidden_count in zip(opponents, hidden_counts):
+        p.add_to_hand(unknown[-hidden_count:] if hidden_count else [])
+        del unknown[len(unknown) - hidden_count:]
+        if p.initial_task:
+            p.initial_task = unknown.pop()
+        waiting_count = len(p.waiting_area)
+        p.waiting_area.clear()
+        if waiting_count:
+            p.waiting_area.extend(unknown[-waiting_count:])
+            del unknown[-waiting_count:]
+    g.deck.cards = unknown
+    g.deck.top = 0
+    return g
+
+
+def position_value(game, player_ix):
+    # The score, plus part of what helpers, the craft bench and the chosen
+    # task are worth towards later turns
+    p = game.players[player_ix]
+    counts = p.zone_counts
+    value = p.score
+    for m in MATERIALS:
+        value += 0.5 * counts[HELPERS + m.id] + 0.25 * m.value * counts[CRAFT_BENCH + m.id]
+    if p.task is not None:
+        value += 0.5 * (1 + p.helper_count(p.task.material) + p.covered_helper_count(p.task.material))
+    return value
+
+
+def relative_value(game, player_ix):
+    values = [position_value(game, i) for i in range(len(game.players))]
+    if len(values) == 1:
+        return values[0]
+    return values[player_ix] - max(v for i, v in enumerate(values) if i != player_ix)
+
+
+class HeuristicAgent:
+    # Greedy search over up to depth consecutive decisions of the deciding
+    # player, judged by relative_value() of the position they lead to, in a
+    # determinization. Depths are searched in turn and a depth's answer is
+    # only taken once it judged every move, so at the deadline the answer of
+    # the deepest complete search is returned. That makes it MCTSAgent's
+    # answer when search runs short of time
+    def __init__(self, rng=None, depth=3):
+        self.rng = rng if rng is not None else random.Random()
+        self.depth = depth
+
+    def choose(self, game, deadline=None, max_depth=None):
+        # max_depth overrides self.depth for this decision
+        player = game.active_player_ix
+        state = determinize(game, player, self.rng)
+        legal = legal_moves(state, self.rng)
+        # Shuffled so ties do not favour the first options
+        self.rng.shuffle(legal)
+        best = legal[0][1]
+        for depth in range(1, (self.depth if max_depth is None else max_depth) + 1):
+            depth_best = None
+            best_value = None
+            deeper = False
+            for _, m in legal:
+                value, cut_off = self.lookahead(state, m, player, depth, deadline)
+                if value is None:
+                    return best
+                deeper = deeper or cut_off
+                if best_value is None or value > best_value:
+                    depth_best, best_value = m, value
+            best = depth_best
+            if not deeper:
+                # No decision was cut off by depth, so deeper searches would
+                # find the same
+                break
+        return best
+
+    def lookahead(self, state, moves, player, depth, deadline):
+        # The value of moves and whether depth cut off a decision after
+        # them. The value is None once the deadline passes
+        if deadline is not None and time.perf_counter() >= deadline:
+            return None, False
+        state = state.clone()
+        state.apply(moves)
+        state.step_until_decision()
+        if state.state == State.GAME_OVER or state.active_player_ix != player:
+            return relative_value(state, player), False
+        if depth <= 1:
+            return relative_value(state, player), True
+        best_value = None
+        cut_off = False
+        for _, m in legal_moves(state, self.rng):
+            value, child_cut_off = self.lookahead(state, m, player, depth - 1, deadline)
+            if value is None:
+                return None, False
+            cut_off = cut_off or child_cut_off
+            if best_value is None or value > best_value:
+                best_value = value
+        return best_value, cut_off
+
+
+class Node:
+    __slots__ = ('parent', 'key', 'player', 'children', 'visits', 'availability', 'reward')
+
+    def __init__(self, parent=None, key=None, player=None):
+        self.parent = parent
+        self.key = key
+        self.player = player
+        self.children = {}
+        self.visits = 0
+        self.availability = 1
+        self.reward = 0.0
+
+    def ucb(self, exploration):
+        return self.reward / self.visits + \
+            exploration * math.sqrt(math.log(self.availability) / self.visits)
+
+
+class MCTSAgent:
+    # Single-observer information set MCTS. Every iteration searches a fresh
+    # determinization of what the deciding player cannot see; the tree is
+    # keyed by card and action identities so it is shared between them.
+    # With an evaluation_cache (see canonical.py), rollout results are
+    # pooled per canonical leaf position, and once a leaf has cache_samples
+    # of them their mean is used instead of another rollout.
+    #
+    # iterations is the number of visits the root should have, so a subtree
+    # kept from an earlier search needs fewer new iterations. When every
+    # decision of the game is passed to observe() (see run_with_pondering),
+    # the tree follows the game from decision to decision and the agent can
+    # ponder(): search on a background thread while someone else decides.
+    #
+    # With a time_limit per decision, or a deadline passed to choose(), the
+    # search is anytime: it stops at the deadline, abandoning a rollout
+    # midway if need be, and plays its most visited move. If no move got
+    # min_visits visits, the HeuristicAgent's move is played instead. It is
+    # worked out before searching whenever the tree holds no such move, in
+    # fallback_share of the time left.
+    def __init__(self, rng=None, iterations=200, time_limit=None, exploration=0.7, rollout_turns=4,
+                 evaluation_cache=None, cache_samples=8, max_ponder_iterations=100000, min_visits=10,
+                 fallback_share=0.1):
+        self.rng = rng if rng is not None else random.Random()
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.exploration = exploration
+        self.rollout_turns = rollout_turns
+        self.rollout_agent = RandomAgent(self.rng)
+        self.evaluation_cache = evaluation_cache
+        self.cache_samples = cache_samples
+        self.max_ponder_iterations = max_ponder_iterations
+        self.min_visits = min_visits
+        self.fallback_share = fallback_share
+        self.fallback_agent = HeuristicAgent(self.rng)
+        self.root = None
+        self.root_position = None
+        # Set once observe() is called; root is then the node of the game's
+        # next decision
+        self.tracking = False
+        self.ponder_thread = None
+        self.ponder_stop = threading.Event()
+
+    def choose(self, game, deadline=None):
+        # deadline is a time.perf_counter() value
+        if deadline is None and self.time_limit is not None:
+            deadline = time.perf_counter() + self.time_limit
+        self.stop_pondering()
+        moves = dict((key, m) for key, m in legal_moves(game, self.rng))
+        if len(moves) == 1:
+            if not self.tracking:
+                self.root = None
+            return next(iter(moves.values()))
+
+        root = self.reusable_root(game)
+        least_visits = 1 if deadline is None else self.min_visits
+        fallback = None
+        if deadline is not None and self.best_child(root, moves, least_visits) is None:
+            now = time.perf_counter()
+            fallback = self.fallback_agent.choose(game, now + self.fallback_share * max(0, deadline - now))
+        self.search(game, root, deadline)
+
+        best = self.best_child(root, moves, least_visits)
+        if best is None:
+            if not self.tracking:
+                self.root = None
+            if fallback is None:
+                # Only reached without a deadline, so the fallback is kept
+                # to one decision deep
+                fallback = self.fallback_agent.choose(game, max_depth=1)
+            return fallback
+
+        if self.tracking:
+            # observe() moves on to the chosen child
+            self.root = root
+        else:
+            # Keep the subtree in case the next decision is ours again in
+            # the same turn with no other player acting in between
+            self.root = best
+            self.root.parent = None
+            self.root_position = (game.turn_number, game.active_player_ix)
+        return moves[best.key]
+
+    @staticmethod
+    def best_child(root, moves, least_visits):
+        # The most visited child of root among moves, if it has least_visits
+        best = max((c for key, c in root.children.items() if key in moves), key=lambda c: c.visits, default=None)
+        return best if best is not None and best.visits >= least_visits else None
+
+    def reusable_root(self, game):
+        if self.root is not None and \
+                (self.tracking or self.root_position == (game.turn_number, game.active_player_ix)):
+            return self.root
+        self.root = Node()
+        return self.root
+
+    def observe(self, game, moves):
+        # Called with every decision before it is applied to game
+        self.stop_pondering()
+        self.tracking = True
+        key = move_key(game, moves)
+        child = self.root.children.get(key) if self.root is not None else None
+        if child is not None:
+            child.parent = None
+        self.root = child
+
+    def ponder(self, game, observer_ix):
+        # Searches the current decision of another player from observer_ix's
+        # point of view until observe() or choose() is called
+        if self.ponder_thread is not None:
+            return
+        if self.root is None:
+            self.root = Node()
+        self.ponder_stop.clear()
+        self.ponder_thread = threading.Thread(
+            target=self.ponder_search, args=(game.clone(), observer_ix, self.root), daemon=True)
+        self.ponder_thread.start()
+
+    def ponder_search(self, game, observer_ix, root):
+        for _ in range(self.max_ponder_iterations):
+            if self.ponder_stop.is_set():
+                break
+            self.iterate(determinize(game, observer_ix, self.rng), root)
+
+    def stop_pondering(self):
+        if self.ponder_thread is not None:
+            self.ponder_stop.set()
+            self.ponder_thread.join()
+            self.ponder_thread = None
+
+    def search(self, game, root, deadline=None):
+        observer = game.active_player_ix
+        while True:
+            if deadline is not None:
+                if time.perf_counter() >= deadline:
+                    break
+            elif root.visits >= self.iterations:
+                break
+            self.iterate(determinize(game, observer, self.rng), root, deadline)
+
+    def iterate(self, state, root, deadline=None):
+        node = root
+        while state.state != State.GAME_OVER:
+            if deadline is not None and time.perf_counter() >= deadline:
+                # Out of time before a node was added
+                return
+            state.step_until_decision()
+            if state.state == State.GAME_OVER:
+                break
+            legal = legal_moves(state, self.rng)
+            untried = [(key, m) for key, m in legal if key not in node.children]
+            if untried:
+                key, m = self.rng.choice(untried)
+                child = Node(node, key, state.active_player_ix)
+                node.children[key] = child
+                for other_key, _ in legal:
+                    if other_key != key and other_key in node.children:
+                        node.children[other_key].availability += 1
+                state.apply(m)
+                node = child
+                break
+            children = [(node.children[key], m) for key, m in legal]
+            for child, _ in children:
+                child.availability += 1
+            child, m = max(children, key=lambda x: x[0].ucb(self.exploration))
+            state.apply(m)
+            node = child
+
+        result = self.evaluate(state, deadline)
+        if result is None:
+            # Out of time: drop the node this iteration added, as nothing
+            # was learned about it
+            if node is not root and not node.visits:
+                del node.parent.children[node.key]
+            return
+        while node is not root:
+            node.visits += 1
+            node.reward += result[node.player]
+            node = node.parent
+        root.visits += 1
+
+    def evaluate(self, state, deadline=None):
+        # None if the deadline passed during the rollout
+        cache = self.evaluation_cache
+        if cache is None:
+            if not self.rollout(state, deadline):
+                return None
+            return rewards(state)
+        key = cache.key(state)
+        entry = cache.get(key)
+        if entry is not None and entry[0] >= self.cache_samples:
+            return [total / entry[0] for total in entry[1]]
+        if not self.rollout(state, deadline):
+            return None
+        result = rewards(state)
+        if entry is None:
+            entry = [0, [0.0] * len(result)]
+            cache.put(key, entry)
+        entry[0] += 1
+        for i, r in enumerate(result):
+            entry[1][i] += r
+        return result
+
+    def rollout(self, state, deadline=None):
+        # False if cut short by the deadline
+        end_turn = state.turn_number + self.rollout_turns
+        while state.state != State.GAME_OVER and state.turn_number < end_turn:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            state.apply(self.rollout_agent.choose(state) if state.moves else None)
+        return True
+
+
+# Decisions whose options are all public, so a determinization of the
+# position keeps them legal
+PUBLIC_DECISIONS = {State.PERFORM_CLERK, State.PERFORM_MONK, State.PERFORM_POTTER, State.PLACE_COMPLETED_WORK}
+
+
+def run_with_pondering(game):
+    # Game.run() that tells every MCTSAgent about every decision, so their
+    # trees follow the game, and lets them ponder while an agent of another
+    # kind, such as a human, decides.
+    #
+    # The options of a pending decision were generated from the decider's
+    # real hand, which a determinization replaces. So bots ponder from the
+    # position just before the options were generated, when that position
+    # needed no input; otherwise only public decisions are pondered on.
+    bots = [(i, a) for i, a in enumerate(game.agents) if isinstance(a, MCTSAgent)]
+    before = None
+    try:
+        while game.state != State.GAME_OVER:
+            # As Game.step
+            if game.moves:
+                agent = game.agents[game.active_player_ix]
+                if not isinstance(agent, MCTSAgent):
+                    position = before if before is not None else \
+                        game if game.state in PUBLIC_DECISIONS else None
+                    if position is not None:
+                        for i, bot in bots:
+                            bot.ponder(position, i)
+                moves = agent.choose(game)
+                for _, bot in bots:
+                    bot.observe(game, moves)
+                before = None
+            else:
+                moves = None
+                before = game.clone() if bots else None
+            if game.verbose:
+                print(f'State is {game.state}')
+            game.apply(moves)
+    finally:
+        for _, bot in bots:
+            bot.stop_pondering()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play against MCTS agents at the terminal')
+    parser.add_argument('-p', '--players', type=int, default=2, help='you and players - 1 agents')
+    parser.add_argument('-i', '--iterations', type=int, default=1000)
+    parser.add_argument('-t', '--time-limit', type=float, help='seconds per decision, instead of iterations')
+    parser.add_argument('--no-ponder', action='store_true', help='do not search while you decide')
+    parser.add_argument('-s', '--seed', type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    game = Game()
+    game.deal(args.players)
+    game.agents = [HumanAgent()] + [
+        MCTSAgent(random.Random(rng.getrandbits(64)), args.iterations, args.time_limit)
+        for _ in range(args.players - 1)
+    ]
+    if args.no_ponder:
+        game.run()
+    else:
+        run_with_pondering(game)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
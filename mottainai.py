@@ -1,97 +1,142 @@
 #!/usr/bin/env python3
 
+import math
 import re
-import random
-from dataclasses import dataclass
-from enum import Enum, auto
+from array import array
+from operator import attrgetter
+from enum import Enum, IntEnum, auto
 from functools import total_ordering
-from collections import Counter
+from collections import Counter, namedtuple
 
-def prompt_choice(player_name, instruction, options, n=1, allow_cancel=True):
-    if isinstance(n, int) and len(options) == n and not allow_cancel:
+from rng import CounterRNG
+
+def forced_choice(option_count, n=1, allow_cancel=True):
+    # The choice when there is nothing to decide, otherwise None
+    if isinstance(n, int) and option_count == n and not allow_cancel:
         if n > 1:
             return list(range(n))
         else:
             return 0
-    print(f'{player_name} - {instruction}:')
-    for i, c in enumerate(options):
-        print(f'  {i+1}. {c}')
+    return None
+
+
+def format_options(options, allow_cancel=True):
+    lines = [f'  {i+1}. {c}' for i, c in enumerate(options)]
     if allow_cancel:
-        print(f'  0. Cancel')
-    while True:
-        choice = input('> ').strip()
-        if n == 1:
-            try:
-                choice = int(choice) - 1
-                if allow_cancel and choice == -1:
+        lines.append(f'  0. Cancel')
+    return lines
+
+
+def parse_choice(choice, option_count, n=1, allow_cancel=True):
+    # Parses a typed choice into what Game.apply() expects, or None if invalid
+    choice = choice.strip()
+    if n == 1:
+        try:
+            choice = int(choice) - 1
+            if allow_cancel and choice == -1:
+                return -1
+            if 0 <= choice < option_count:
+                return choice
+        except:
+            pass
+    else:
+        try:
+            if not choice:
+                l = []
+            else:
+                l = list(set(int(x) - 1 for x in re.split('[, ]', choice)))
+            if isinstance(n, tuple):
+                # Allow a range of choices
+                # cancel must be on its own
+                if allow_cancel and l == [-1]:
                     return -1
-                if 0 <= choice < len(options):
-                    return choice
-            except:
-                pass
-        else:
-            try:
-                if not choice:
-                    l = []
-                else:
-                    l = list(set(int(x) - 1 for x in re.split('[, ]', choice)))
-                if isinstance(n, tuple):
-                    # Allow a range of choices
-                    # cancel must be on its own
-                    if allow_cancel and l == [-1]:
-                        return -1
-                    if allow_cancel and len(l) > 1 and -1 in l:
-                        pass
-                    elif n[0] <= len(l) <= n[1] and all(0 <= x < len(options) for x in l):
-                        return l
-                else:
-                    if len(set(l)) == n and all(0 <= x < len(options) for x in l):
-                        return l
-            except:
-                pass
+                if allow_cancel and len(l) > 1 and -1 in l:
+                    pass
+                elif n[0] <= len(l) <= n[1] and all(0 <= x < option_count for x in l):
+                    return l
+            else:
+                if len(set(l)) == n and all(0 <= x < option_count for x in l):
+                    return l
+        except:
+            pass
+    return None
+
+
+def prompt_choice(player_name, instruction, options, n=1, allow_cancel=True):
+    forced = forced_choice(len(options), n, allow_cancel)
+    if forced is not None:
+        return forced
+    print(f'{player_name} - {instruction}:')
+    for line in format_options(options, allow_cancel):
+        print(line)
+    while True:
+        choice = parse_choice(input('> '), len(options), n, allow_cancel)
+        if choice is not None:
+            return choice
         print('Invalid choice')
 
 
-@dataclass(frozen=True)
-class Material:
-    id: int
-    name: str
-    value: int
-    symbol: str
-    task: str
-    description: str
+class HumanAgent:
+    def choose(self, game):
+        return prompt_choice(
+            game.active_player.name,
+            game.instruction,
+            game.possible_moves,
+            game.number_of_moves_to_choose,
+            game.allow_cancel)
 
-    def __eq__(self, other):
-        if isinstance(other, Material):
-            return self.id == other.id
-        else:
-            return False
+
+class Material:
+    # Materials and cards are singletons, so equality is identity and the
+    # default hash serves for dict keys. Unpickling looks the singleton up
+    # by id instead of building a copy
+    __slots__ = ('id', 'name', 'value', 'symbol', 'task', 'description')
+
+    def __init__(self, id, name, value, symbol, task, description):
+        self.id = id
+        self.name = name
+        self.value = value
+        self.symbol = symbol
+        self.task = task
+        self.description = description
 
     def __repr__(self):
         return self.name
 
+    def __reduce__(self):
+        return material_by_id, (self.id,)
+
 PAPER = Material(1, 'Paper', 1, '📜', 'Clerk', 'Sell a material')
 STONE = Material(2, 'Stone', 2, '🗿', 'Monk', 'Hire a helper')
 CLOTH = Material(3, 'Cloth', 2, '🧵', 'Tailor', 'Refill your hand')
 CLAY = Material(4, 'Clay', 3, '🧱', 'Potter', 'Collect a material')
 METAL = Material(5, 'Metal', 3, '🔧', 'Smith', 'Complete any work')
 
-@dataclass(frozen=True)
+MATERIALS = [PAPER, STONE, CLOTH, CLAY, METAL]
+
+
+def material_by_id(material_id):
+    return MATERIALS[material_id - 1]
+
+
 @total_ordering
 class Card:
-    id: int
-    name: str
-    material: Material
+    __slots__ = ('id', 'name', 'material')
 
-    def __eq__(self, other):
-        return self.id == other.id
+    def __init__(self, id, name, material):
+        self.id = id
+        self.name = name
+        self.material = material
 
     def __lt__(self, other):
-        return (self.id, self.name) < (other.id, other.name)
+        return self.id < other.id
 
     def __repr__(self):
         return f'{self.name} {self.material.symbol}'
 
+    def __reduce__(self):
+        return card_by_id, (self.id,)
+
 CRANE = Card(1, 'Crane', PAPER)
 CURTAIN = Card(2, 'Curtain', PAPER)
 DECK_OF_CARDS = Card(3, 'Deck of Cards', PAPER)
@@ -156,40 +201,144 @@ CARDS = [
     FLUTE, SWORD, SHURIKEN, GONG, PIN, COIN, TURTLE, BELL, CHOPSTICKS
 ]
 
+CARD_BY_ID = [None] * (max(c.id for c in CARDS) + 1)
+for c in CARDS:
+    CARD_BY_ID[c.id] = c
+
+
+def card_by_id(card_id):
+    return CARD_BY_ID[card_id]
+
+
+class Action(IntEnum):
+    TASK = 1
+    PRAY = 2
+    CLERK = 3
+    MONK = 4
+    TAILOR = 5
+    POTTER = 6
+    SMITH = 7
+    CRAFT = 8
+    SELL = 9
+    HIRE = 10
+    RETURN = 11
+    COLLECT = 12
+    SMITH_WORK = 13
+    REVEAL = 14
+    CRAFT_WORK = 15
+    GALLERY = 16
+    GIFT_SHOP = 17
+
+TASK_ACTIONS = {
+    PAPER: Action.CLERK,
+    STONE: Action.MONK,
+    CLOTH: Action.TAILOR,
+    CLAY: Action.POTTER,
+    METAL: Action.SMITH,
+}
+
+HAND_CARD_ACTIONS = (Action.RETURN, Action.SMITH_WORK, Action.CRAFT_WORK)
+
+# A move is an int: the action in the high bits and a card id (0 for none)
+# in the low 6 bits
+
+
+def encode_move(action, card=None):
+    return action << 6 | (card.id if card is not None else 0)
+
+
+def move_action(move):
+    return move >> 6
+
+
+def move_card(move):
+    return CARD_BY_ID[move & 63]
+
 
-@dataclass
 @total_ordering
 class HandCard:
-    card: Card
-    visible: bool = False
+    __slots__ = ('card', 'visible')
+
+    def __init__(self, card, visible=False):
+        self.card = card
+        self.visible = visible
 
     def __repr__(self):
         return f'{self.card}{" 👁" if self.visible else ""}'
 
-    def __cmp__(self, other):
-        return self.card.__cmp__(other.card)
+    def __eq__(self, other):
+        if isinstance(other, HandCard):
+            return self.card is other.card and self.visible == other.visible
+        return NotImplemented
 
     def __lt__(self, other):
-        return self.card.__lt__(other.card)
+        return self.card.id < other.card.id
+
+
+hand_card_id = attrgetter('card.id')
 
 
 class Hand(list):
+    __slots__ = ()
+
     def add_to_hand(self, cards):
         for c in cards:
             self.append(HandCard(c))
-        self.sort()
+        # Sorting on int keys never calls back into Python
+        self.sort(key=hand_card_id)
 
     def hide(self):
         for c in self:
             c.visible = False
 
+    def remove_indices(self, indices):
+        removed = [self[i].card for i in indices]
+        self[:] = [c for i, c in enumerate(self) if i not in indices]
+        return removed
+
+    def index_of(self, card):
+        for i, c in enumerate(self):
+            if c.card.id == card.id:
+                return i
+        raise ValueError(f'{card} not in hand')
+
+    def material_counts(self):
+        return Counter(c.card.material for c in self)
+
+    def copy(self):
+        return Hand(HandCard(c.card, c.visible) for c in self)
+
+    def snapshot(self):
+        return [(c, c.visible) for c in self]
+
+    def restore(self, snapshot):
+        self[:] = [c for c, _ in snapshot]
+        for c, visible in snapshot:
+            c.visible = visible
+
     def format_hand(self, is_active=False):
         if is_active:
             return str(self)
         else:
-            items = ', '.join(sorted(c.card if c.visible else '?' for c in self))
+            items = ', '.join(sorted(str(c.card) if c.visible else '?' for c in self))
             return f'[{items}]'
 
+    @property
+    def mask(self):
+        # Bit card.id is set for every card, as CardSetHand.mask
+        mask = 0
+        for c in self:
+            mask |= 1 << c.card.id
+        return mask
+
+    @property
+    def visible_mask(self):
+        mask = 0
+        for c in self:
+            if c.visible:
+                mask |= 1 << c.card.id
+        return mask
+
     @property
     def revealed_cards(self):
         return [c for c in self if c.visible]
@@ -199,59 +348,261 @@ class Hand(list):
         return [c for c in self if not c.visible]
 
 
+class Zone(list):
+    __slots__ = ()
+
+    def material_counts(self):
+        return Counter(c.material for c in self)
+
+    @property
+    def mask(self):
+        # Bit card.id is set for every card, as CardSet.mask
+        mask = 0
+        for c in self:
+            mask |= 1 << c.id
+        return mask
+
+    def copy(self):
+        return Zone(self)
+
+    def snapshot(self):
+        return self[:]
+
+    def restore(self, snapshot):
+        self[:] = snapshot
+
+
+class ListBackend:
+    # Zone types used for a player's cards and the floor. See cardset.py for
+    # a bitset alternative with the same interface
+    zone = Zone
+    hand = Hand
+
+
+PLAYER_ZONES = ('hand', 'gallery', 'gift_shop', 'helpers', 'craft_bench', 'sales', 'waiting_area')
+COVER_ZONES = ('helpers', 'gallery', 'gift_shop', 'sales')
+COUNTED_ZONES = COVER_ZONES + ('hand', 'craft_bench')
+# Player.zone_counts holds one run of per-material counts for each counted
+# zone, indexed by the zone's offset plus the material id
+COUNTS_STRIDE = len(MATERIALS) + 1
+COUNTS_OFFSET = {zone: i * COUNTS_STRIDE for i, zone in enumerate(COUNTED_ZONES)}
+HELPERS = COUNTS_OFFSET['helpers']
+GALLERY = COUNTS_OFFSET['gallery']
+GIFT_SHOP = COUNTS_OFFSET['gift_shop']
+SALES = COUNTS_OFFSET['sales']
+HAND = COUNTS_OFFSET['hand']
+CRAFT_BENCH = COUNTS_OFFSET['craft_bench']
+
+# Which works can be completed depends only on the hand and craft bench
+# counts of each material, and only up to a cap: a work of value v can be
+# smithed with v cards of its material in hand and crafted with v - 1 on
+# the craft bench (Paper needs nothing). Player.works_index packs the capped
+# counts in mixed radix and is kept up to date by every count change, so
+# COMPLETEABLE_WORKS[works_index] gives the (smith, craft) materials at once.
+WORKS_CAPS = [(HAND + m.id, m.value) for m in MATERIALS] + \
+    [(CRAFT_BENCH + m.id, m.value - 1) for m in MATERIALS]
+WORKS_STRIDES = {}
+WORKS_INDICES = 1
+for count_ix, cap in WORKS_CAPS:
+    WORKS_STRIDES[count_ix] = WORKS_INDICES
+    WORKS_INDICES *= cap + 1
+# WORKS_STEPS[count_ix][count] is what works_index changes by when the count
+# at zone_counts[count_ix] goes from count to count + 1
+MAX_MATERIAL_COUNT = max(Counter(c.material for c in CARDS).values())
+WORKS_STEPS = [[0] * (MAX_MATERIAL_COUNT + 1) for _ in range(len(COUNTED_ZONES) * COUNTS_STRIDE)]
+for count_ix, cap in WORKS_CAPS:
+    for count in range(cap):
+        WORKS_STEPS[count_ix][count] = WORKS_STRIDES[count_ix]
+
+
+def completeable_works(works_index):
+    counts = {}
+    for count_ix, cap in WORKS_CAPS:
+        counts[count_ix] = works_index // WORKS_STRIDES[count_ix] % (cap + 1)
+    smith = []
+    craft = []
+    for m in MATERIALS:
+        if not counts[HAND + m.id]:
+            continue
+        if m == PAPER or counts[HAND + m.id] >= m.value:
+            smith.append(m)
+        if m == PAPER or counts[CRAFT_BENCH + m.id] >= m.value - 1:
+            craft.append(m)
+    return tuple(smith), tuple(craft)
+
+
+COMPLETEABLE_WORKS = [completeable_works(i) for i in range(WORKS_INDICES)]
+
+
 class Player:
-    def __init__(self, i):
+    __slots__ = ('name', 'task', 'initial_task', 'zone_counts', 'works_index') + PLAYER_ZONES
+
+    def __init__(self, i, backend=ListBackend):
         self.name = f'Player {i}'
-        self.hand = Hand()
-        self.gallery = []
-        self.gift_shop = []
-        self.helpers = []
-        self.craft_bench = []
-        self.sales = []
-        self.waiting_area = []
+        self.hand = backend.hand()
+        self.gallery = backend.zone()
+        self.gift_shop = backend.zone()
+        self.helpers = backend.zone()
+        self.craft_bench = backend.zone()
+        self.sales = backend.zone()
+        self.waiting_area = backend.zone()
         self.task = None
         self.initial_task = None
-        self.covered_helpers = Counter()
-        self.covered_sales_value = Counter()
+        # Per-material card counts of the zones that take part in cover or
+        # in completing works. Cards must enter and leave those zones through
+        # add_card/remove_card and the hand methods below to keep them right
+        self.zone_counts = [0] * (len(COUNTED_ZONES) * COUNTS_STRIDE)
+        self.works_index = 0
+
+    def clone(self):
+        other = Player.__new__(Player)
+        other.name = self.name
+        for zone in PLAYER_ZONES:
+            setattr(other, zone, getattr(self, zone).copy())
+        other.task = self.task
+        other.initial_task = self.initial_task
+        other.zone_counts = self.zone_counts[:]
+        other.works_index = self.works_index
+        return other
+
+    def snapshot(self):
+        return (
+            self.task,
+            self.initial_task,
+            [getattr(self, zone).snapshot() for zone in PLAYER_ZONES],
+            self.zone_counts[:],
+            self.works_index,
+        )
+
+    def restore(self, snapshot):
+        self.task, self.initial_task, zones, self.zone_counts, self.works_index = snapshot
+        for zone, zone_snapshot in zip(PLAYER_ZONES, zones):
+            getattr(self, zone).restore(zone_snapshot)
+
+    def count_card(self, count_ix):
+        count = self.zone_counts[count_ix]
+        self.works_index += WORKS_STEPS[count_ix][count]
+        self.zone_counts[count_ix] = count + 1
+
+    def uncount_card(self, count_ix):
+        count = self.zone_counts[count_ix] - 1
+        self.works_index -= WORKS_STEPS[count_ix][count]
+        self.zone_counts[count_ix] = count
+
+    def add_card(self, zone, card):
+        getattr(self, zone).append(card)
+        self.count_card(COUNTS_OFFSET[zone] + card.material.id)
+
+    def remove_card(self, zone, card):
+        getattr(self, zone).remove(card)
+        self.uncount_card(COUNTS_OFFSET[zone] + card.material.id)
 
-    def calculate_cover(self):
-        self.covered_helpers = Counter()
-        helpers_by_material = Counter(helper.material for helper in self.helpers)
-        gallery_works_by_material = Counter(work.material for work in self.gallery)
-        for material, count in helpers_by_material.items():
-            if count <= gallery_works_by_material[material] * material.value:
-                self.covered_helpers[material] = helpers_by_material[material]
+    def add_to_hand(self, cards):
+        self.hand.add_to_hand(cards)
+        for c in cards:
+            self.count_card(HAND + c.material.id)
+
+    def remove_from_hand(self, card):
+        self.hand.pop(self.hand.index_of(card))
+        self.uncount_card(HAND + card.material.id)
+
+    def remove_hand_indices(self, indices):
+        cards = self.hand.remove_indices(indices)
+        for c in cards:
+            self.uncount_card(HAND + c.material.id)
+        return cards
+
+    def helper_count(self, material):
+        return self.zone_counts[HELPERS + material.id]
+
+    def covered_helper_count(self, material):
+        count = self.zone_counts[HELPERS + material.id]
+        if count <= self.zone_counts[GALLERY + material.id] * material.value:
+            return count
+        return 0
 
-        self.covered_sales_value = Counter()
-        sales_by_material = Counter(helper.material for helper in self.sales)
-        gift_shop_works_by_material = Counter(work.material for work in self.gift_shop)
-        for material, count in sales_by_material.items():
-            if count <= gift_shop_works_by_material[material] * material.value:
-                self.covered_sales_value[material] = count * material.value
+    def covered_sales_value_of(self, material):
+        count = self.zone_counts[SALES + material.id]
+        if count <= self.zone_counts[GIFT_SHOP + material.id] * material.value:
+            return count * material.value
+        return 0
+
+    @property
+    def covered_helpers(self):
+        return Counter({m: n for m in MATERIALS if (n := self.covered_helper_count(m))})
+
+    @property
+    def covered_sales_value(self):
+        return Counter({m: v for m in MATERIALS if (v := self.covered_sales_value_of(m))})
+
+    @property
+    def score(self):
+        works_value = sum(work.material.value for work in self.gallery) + \
+            sum(work.material.value for work in self.gift_shop)
+        return works_value + sum(self.covered_sales_value_of(m) for m in MATERIALS)
 
 
 class Deck:
+    __slots__ = ('cards', 'top', 'exhausted')
+
+    # Cards are drawn from the front by advancing self.top instead of popping,
+    # and returned cards go to the back. The drawn prefix is dropped once it
+    # makes up most of the list, so draws and returns are amortized O(1).
     def __init__(self, cards):
         self.cards = cards
+        self.top = 0
+        # Set when a draw could not be completed. The game ends at that point
+        self.exhausted = False
 
     def __repr__(self):
-        return repr(self.cards)
+        return repr(self.cards[self.top:])
 
     def __len__(self):
-        return len(self.cards)
+        return len(self.cards) - self.top
 
     def draw(self, n=1):
-        # TODO: Handle end of game whenever a draw is possible
-        if n == 1:
-            return self.cards.pop(0)
-        else:
-            return [self.cards.pop(0) for _ in range(n)]
+        if n != 1:
+            return self.draw_cards(n)
+        if self.top == len(self.cards):
+            self.exhausted = True
+            return None
+        card = self.cards[self.top]
+        self.top += 1
+        self.compact()
+        return card
+
+    def draw_cards(self, n):
+        cards = self.cards[self.top:self.top + n]
+        self.top += len(cards)
+        if len(cards) < n:
+            self.exhausted = True
+        self.compact()
+        return cards
 
     def return_cards(self, cards):
         if isinstance(cards, list):
             self.cards.extend(cards)
         else:
-            self.cards.append(card)
+            self.cards.append(cards)
+
+    def compact(self):
+        # Rebind rather than trim in place: the list is then only ever
+        # appended to, which is what lets Game.undo restore it by truncation
+        if self.top > 32 and 2 * self.top > len(self.cards):
+            self.cards = self.cards[self.top:]
+            self.top = 0
+
+    def clone(self):
+        other = Deck(self.cards[self.top:])
+        other.exhausted = self.exhausted
+        return other
+
+    def snapshot(self):
+        return (self.cards, len(self.cards), self.top, self.exhausted)
+
+    def restore(self, snapshot):
+        self.cards, length, self.top, self.exhausted = snapshot
+        del self.cards[length:]
 
 
 class State(Enum):
@@ -278,472 +629,832 @@ class State(Enum):
     GAME_OVER = auto()
 
 
+class Event(IntEnum):
+    GOES_FIRST = 1
+    TURN_STARTS = 2
+    RETURNS_CARDS = 3
+    MORNING_EFFECTS = 4
+    INITIAL_TASK_TO_FLOOR = 5
+    PREVIOUS_TASK_TO_FLOOR = 6
+    NO_NEW_TASK = 7
+    NEW_TASK = 8
+    PERFORMS_OPPONENT_TASK = 9
+    OPPONENT_HAS_NO_TASK = 10
+    ACTIONS_AVAILABLE = 11
+    CANNOT_WITH_EMPTY_CRAFT_BENCH = 12
+    CANNOT_WITH_EMPTY_FLOOR = 13
+    PRAYS = 14
+    TAILOR = 15
+    SELLS = 16
+    HIRES = 17
+    DRAWS_INTO_WAITING_AREA = 18
+    COLLECTS = 19
+    REVEALS = 20
+    WING_FULL = 21
+    PERFORMS_OWN_TASK = 22
+    NIGHT_EFFECTS = 23
+    DRAWS_FROM_WAITING_AREA = 24
+    DECK_EMPTY = 25
+
+# Every event carries the active player's index, a card id (0 for none) and
+# an int whose meaning depends on the event: a card count, an opponent's
+# index, or 0/1 for gallery/gift shop
+GameEvent = namedtuple('GameEvent', 'kind player card value')
+
+
+def plural(n):
+    return '' if n == 1 else 's'
+
+
+def format_event(kind, player, card, value):
+    card = CARD_BY_ID[card]
+    name = f'Player {player + 1}'
+    if kind == Event.GOES_FIRST:
+        return f'{name} goes first'
+    elif kind == Event.TURN_STARTS:
+        return f"{name}'s turn"
+    elif kind == Event.RETURNS_CARDS:
+        return f'{name} returns {value} card{plural(value)}'
+    elif kind == Event.MORNING_EFFECTS:
+        return 'TODO: morning effects'
+    elif kind == Event.INITIAL_TASK_TO_FLOOR:
+        return f'{name} initial task {card} added to floor'
+    elif kind == Event.PREVIOUS_TASK_TO_FLOOR:
+        return f'{name} previous task {card} added to floor'
+    elif kind == Event.NO_NEW_TASK:
+        return f'{name} chooses no new task'
+    elif kind == Event.NEW_TASK:
+        return f'{name} chooses new task {card.material.task} - {card}'
+    elif kind == Event.PERFORMS_OPPONENT_TASK:
+        return f"{name} performs opponent Player {value + 1}'s {card.material.task} task"
+    elif kind == Event.OPPONENT_HAS_NO_TASK:
+        return f'Opponent Player {value + 1} has no task'
+    elif kind == Event.ACTIONS_AVAILABLE:
+        return f'{name} - {value} {card.material.task} action{plural(value)} available'
+    elif kind == Event.CANNOT_WITH_EMPTY_CRAFT_BENCH:
+        return f'{name} cannot {card.material.task} with an empty craft bench'
+    elif kind == Event.CANNOT_WITH_EMPTY_FLOOR:
+        return f'{name} cannot {card.material.task} with an empty floor'
+    elif kind == Event.PRAYS:
+        return f'{name} prays'
+    elif kind == Event.TAILOR:
+        return f'{name} TODO: Tailor'
+    elif kind == Event.SELLS:
+        return f'{name} moves {card} from craft bench to sales'
+    elif kind == Event.HIRES:
+        return f'{name} moves {card} from floor to helpers'
+    elif kind == Event.DRAWS_INTO_WAITING_AREA:
+        return f'{name} draws {value} card{plural(value)} into the waiting area'
+    elif kind == Event.COLLECTS:
+        return f'{name} moves {card} from floor to craft bench'
+    elif kind == Event.REVEALS:
+        return f'{name} reveals {card}'
+    elif kind == Event.WING_FULL:
+        return f'{name} {"Gift Shop" if value else "Gallery"} has 5 works. Game over.'
+    elif kind == Event.PERFORMS_OWN_TASK:
+        if card is None:
+            return f'{name} performs own missing task'
+        return f'{name} performs own {card.material.task} task'
+    elif kind == Event.NIGHT_EFFECTS:
+        return 'TODO: night effects'
+    elif kind == Event.DRAWS_FROM_WAITING_AREA:
+        return f'{name} draws {value} card{plural(value)} from the waiting area'
+    elif kind == Event.DECK_EMPTY:
+        return 'Deck is empty. Game over.'
+    raise Exception(f'Unknown event {kind}')
+
+
+class TextSink:
+    # Formats events as text lines, the way Game.log used to print them
+    def __init__(self, file=None):
+        self.file = file
+
+    def __call__(self, kind, player, card, value):
+        print(f'LOG: {format_event(kind, player, card, value)}.', file=self.file)
+
+
+class EventLog:
+    # Ring buffer of events in preallocated arrays. Once full, the oldest
+    # events are overwritten
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.kinds = array('B', bytes(capacity))
+        self.players = array('b', bytes(capacity))
+        self.cards = array('B', bytes(capacity))
+        self.values = array('b', bytes(capacity))
+        self.count = 0
+
+    def record(self, kind, player, card, value):
+        i = self.count % self.capacity
+        self.kinds[i] = kind
+        self.players[i] = player
+        self.cards[i] = card
+        self.values[i] = value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __iter__(self):
+        for n in range(self.count - len(self), self.count):
+            i = n % self.capacity
+            yield GameEvent(Event(self.kinds[i]), self.players[i], self.cards[i], self.values[i])
+
+    def clear(self):
+        self.count = 0
+
+    def format(self):
+        return [f'{format_event(*e)}.' for e in self]
+
+
+# Game attributes that a single step may rebind. Mutable containers are
+# journaled separately in Game.undo_record
+STEP_FIELDS = (
+    'state', 'submitted_moves', 'moves', 'number_of_moves_to_choose', 'allow_cancel',
+    'current_task_to_perform', 'current_task_is_of_opponent',
+    'current_action_num', 'actions_to_perform', 'completeable_smith_works',
+    'completeable_craft_works', 'completed_work', 'active_player_ix',
+    'turn_number',
+)
+get_step_fields = attrgetter(*STEP_FIELDS)
+GAME_FIELDS = STEP_FIELDS + (
+    'verbose', 'events', 'sink', 'rng', 'agents', 'backend', 'players', 'floor', 'deck',
+    'first_player_ix', 'opponents_with_tasks', 'next_states', 'undo_log', 'record',
+)
+get_game_fields = attrgetter(*GAME_FIELDS)
+
+
 class Game:
-    def __init__(self):
-        self.floor = []
+    # Slots keep a Game small enough to hold millions of them in a search
+    # tree. Subclasses should declare __slots__ = () too
+    __slots__ = GAME_FIELDS
+
+    def __init__(self, verbose=True, rng=None, backend=ListBackend, events=None, sink=None):
+        # When verbose is False, the game performs no I/O at all and every
+        # decision is delegated to the agents passed to start_game
+        self.verbose = verbose
+        # Game events go to an optional EventLog and an optional sink
+        # callable; with neither, emitting an event costs one check
+        self.events = events
+        self.sink = sink if sink is not None or not verbose else TextSink()
+        # Each game owns its RNG so games never perturb each other's streams.
+        # Any random.Random-like object will do; a CounterRNG is also copied
+        # by clone()
+        self.rng = rng if rng is not None else CounterRNG()
+        self.agents = None
+        self.backend = backend
+        self.players = None
+        self.floor = backend.zone()
+        self.deck = None
+        self.state = None
         self.active_player_ix = None
+        self.first_player_ix = None
+        self.turn_number = None
 
-        # These are for the state machine move selection
-        self.possible_moves = None
-        self.possible_moves_internal = None
-        self.instruction = None
+        # These are for the state machine move selection. moves holds the
+        # options of the pending decision as move ints; submitted_moves are
+        # indices into it
+        self.moves = None
         self.number_of_moves_to_choose = None
         self.allow_cancel = False
         self.submitted_moves = None
 
         self.opponents_with_tasks = None
         self.current_task_to_perform = None
+        self.current_task_is_of_opponent = False
         self.current_action_num = None
         self.actions_to_perform = None
-        self.completeable_smith_works = []
-        self.completeable_craft_works = []
+        self.completeable_smith_works = ()
+        self.completeable_craft_works = ()
         self.completed_work = None
         self.next_states = []
 
+        # When a list, apply() pushes an undo record per step for undo()
+        self.undo_log = None
+        # When set (see replay.GameRecord), deal() and apply() write the deck
+        # order and every decision into it. Steps that need no input are not
+        # written, as replaying runs them again
+        self.record = None
+
     def reset_possible_moves(self):
-        self.possible_moves = None
+        self.moves = None
         self.allow_cancel = False
 
-    def start_game(self, player_count=1):
-        self.players = [Player(i + 1) for i in range(player_count)]
-        self.deck = Deck(random.sample(CARDS, len(CARDS)))
+    def legal_moves(self):
+        return self.moves or []
+
+    @property
+    def possible_moves(self):
+        # Display labels, built only when something asks for them
+        if self.moves is None:
+            return None
+        return [render_move(self, m) for m in self.moves]
+
+    @property
+    def instruction(self):
+        return render_instruction(self)
+
+    def start_game(self, player_count=1, agents=None):
+        self.deal(player_count)
+        if agents is None:
+            agents = [HumanAgent() for _ in range(player_count)]
+        self.agents = agents
+        self.run()
+
+    def deal(self, player_count=1, cards=None):
+        # cards fixes the deck order, top card first, e.g. to replay a game
+        self.players = [Player(i + 1, self.backend) for i in range(player_count)]
+        self.deck = Deck(list(cards) if cards is not None else self.rng.sample(CARDS, len(CARDS)))
+        if self.record is not None:
+            self.record.start(player_count, self.deck.cards)
+        first_floor_cards = []
         for p in self.players:
-            p.hand.add_to_hand(self.deck.draw(5))
+            p.add_to_hand(self.deck.draw(5))
             p.initial_task = self.deck.draw()
-            self.floor.append(self.deck.draw())
-        self.active_player_ix = sorted(enumerate(self.floor), key=lambda x: x[1].name.lower())[0][0]
+            first_floor_cards.append(self.deck.draw())
+            self.floor.append(first_floor_cards[-1])
+        # Zones need not keep insertion order, so pick from the dealt cards
+        self.active_player_ix = min(range(player_count), key=lambda i: first_floor_cards[i].name.lower())
         self.first_player_ix = self.active_player_ix
         self.turn_number = 1
-        self.log('goes first')
+        self.emit(Event.GOES_FIRST)
         self.print_state()
         self.state = State.DISCARD_OLD_TASK
+
+    def run(self):
         while self.state != State.GAME_OVER:
-            if self.possible_moves:
-                self.submitted_moves = prompt_choice(
-                    self.active_player.name,
-                    self.instruction,
-                    self.possible_moves,
-                    self.number_of_moves_to_choose,
-                    self.allow_cancel)
-            print(f'State is {self.state}')
-            self.handle_state()
+            self.step()
 
-    def log(self, message, player_name=True, space=True):
-        print('LOG: ', end='')
-        if player_name:
-            print(f'{self.active_player.name}{" " if space else ""}', end='')
-        print(f'{message}.')
+    def step(self):
+        if self.moves:
+            moves = self.agents[self.active_player_ix].choose(self)
+        else:
+            moves = None
+        if self.verbose:
+            print(f'State is {self.state}')
+        self.apply(moves)
+
+    def apply(self, moves):
+        if self.undo_log is not None:
+            self.undo_log.append(self.undo_record())
+        if self.record is not None and self.moves:
+            self.record.append(moves)
+        self.submitted_moves = moves
+        self.handle_state()
+        if self.deck.exhausted and self.state != State.GAME_OVER:
+            self.emit(Event.DECK_EMPTY)
+            self.reset_possible_moves()
+            self.state = State.GAME_OVER
+
+    def undo_record(self):
+        # A step only ever changes the active player, the floor, the deck and
+        # the game's own fields, so only those are recorded
+        return (
+            get_step_fields(self),
+            self.next_states[:],
+            None if self.opponents_with_tasks is None else self.opponents_with_tasks[:],
+            self.active_player.snapshot(),
+            self.floor.snapshot(),
+            self.deck.snapshot(),
+        )
+
+    def undo(self):
+        fields, next_states, opponents_with_tasks, player, floor, deck = self.undo_log.pop()
+        for name, value in zip(STEP_FIELDS, fields):
+            setattr(self, name, value)
+        # Only decisions were recorded
+        if self.record is not None and self.moves:
+            self.record.pop()
+        self.next_states = next_states
+        self.opponents_with_tasks = opponents_with_tasks
+        self.active_player.restore(player)
+        self.floor.restore(floor)
+        self.deck.restore(deck)
+
+    def clone(self):
+        # Cards and materials are immutable and shared; only the containers
+        # that steps mutate are copied
+        other = Game.__new__(Game)
+        for name, value in zip(GAME_FIELDS, get_game_fields(self)):
+            setattr(other, name, value)
+        other.players = [p.clone() for p in self.players]
+        other.floor = self.floor.copy()
+        other.deck = self.deck.clone()
+        other.next_states = self.next_states[:]
+        if self.opponents_with_tasks is not None:
+            other.opponents_with_tasks = [other.players[self.players.index(p)] for p in self.opponents_with_tasks]
+        # A CounterRNG is copied so the clone's draws leave this game's stream
+        # alone; other RNGs are too costly to copy and stay shared
+        if type(self.rng) is CounterRNG:
+            other.rng = self.rng.copy()
+        other.undo_log = None
+        other.record = None
+        # Clones are for search and stay silent
+        other.verbose = False
+        other.events = None
+        other.sink = None
+        return other
+
+    def emit(self, kind, card=None, value=0):
+        if self.events is None and self.sink is None:
+            return
+        card_id = card.id if card is not None else 0
+        if self.events is not None:
+            self.events.record(kind, self.active_player_ix, card_id, value)
+        if self.sink is not None:
+            self.sink(kind, self.active_player_ix, card_id, value)
 
     @property
     def active_player(self):
         return self.players[self.active_player_ix]
 
     def find_completeable_works(self):
-        self.completeable_smith_works = []
-        self.completeable_craft_works = []
-        materials_in_hand = Counter(c.card.material for c in self.active_player.hand)
-        materials_in_craft_bench = Counter(c.material for c in self.active_player.craft_bench)
-        for material, hand_count in materials_in_hand.items():
-            if material == PAPER:
-                self.completeable_smith_works.append(material)
-                self.completeable_craft_works.append(material)
-            else:
-                cost = material.value - 1
-                if hand_count - 1 >= cost:
-                    self.completeable_smith_works.append(material)
-                if materials_in_craft_bench[material] >= cost:
-                    self.completeable_craft_works.append(material)
+        self.completeable_smith_works, self.completeable_craft_works = \
+            COMPLETEABLE_WORKS[self.active_player.works_index]
+
+    def pray(self):
+        self.emit(Event.PRAYS)
+        card = self.deck.draw()
+        if card is not None:
+            self.active_player.waiting_area.append(card)
 
     def handle_state(self):
-        if self.state == State.CHECK_HAND_SIZE:
-            self.log("'s turn", space=False)
-            if len(self.active_player.hand) <= 5:
-                self.state = State.MORNING_EFFECTS
-            else:
-                n = len(self.active_player.hand) - 5
-                self.instruction = f'Choose {n} card{"s" if n > 1 else ""} from your hand to return'
-                self.possible_moves = self.active_player.hand
-                self.number_of_moves_to_choose = n
-                self.state = State.REDUCE_HAND
-        elif self.state == State.REDUCE_HAND:
-            if isinstance(self.submitted_moves, int):
-                self.submitted_moves = [self.submitted_moves]
-            returned_cards = [self.active_player.hand[i].card for i in self.submitted_moves]
-            self.active_player.hand = Hand(x for i, x in enumerate(self.active_player.hand) if i not in self.submitted_moves)
-            self.reset_possible_moves()
-            self.deck.return_cards(returned_cards)
-            self.active_player.hand.hide()
-            self.log(f'returns {len(returned_cards)} card{"s" if len(returned_cards) > 1 else ""}')
+        handler = STATE_HANDLERS.get(self.state)
+        if handler is None:
+            raise Exception(f'Unknown state {self.state}')
+        handler(self)
+
+    def step_until_decision(self):
+        # Run every state that needs no input, stopping at the next decision
+        # or at the end of the game
+        while not self.moves and self.state != State.GAME_OVER:
+            self.apply(None)
+
+    def handle_check_hand_size(self):
+        self.emit(Event.TURN_STARTS)
+        if len(self.active_player.hand) <= 5:
             self.state = State.MORNING_EFFECTS
-        elif self.state == State.MORNING_EFFECTS:
-            # TODO
-            self.log('TODO: morning effects', player_name=False)
-            self.state = State.DISCARD_OLD_TASK
-        elif self.state == State.DISCARD_OLD_TASK:
-            if self.active_player.initial_task:
-                self.floor.append(self.active_player.initial_task)
-                self.log(f'initial task {self.active_player.initial_task} added to floor')
-                self.active_player.initial_task = None
-            elif self.active_player.task:
-                self.floor.append(self.active_player.task)
-                self.log(f'previous task {self.active_player.task} added to floor')
-                self.active_player.task = None
-
-            if not self.active_player.hand:
-                self.log('chooses no new task')
-                self.state = State.PERFORM_OPPONENT_TASK
-            else:
-                self.instruction = 'Choose task'
-                self.possible_moves = [f'{x.card.material.task} ({x.card.material.description}) - {x.card}' for x in self.active_player.hand]
-                self.possible_moves.append('Pray')
-                self.number_of_moves_to_choose = 1
-                self.state = State.CHOOSE_NEW_TASK
-        elif self.state == State.CHOOSE_NEW_TASK:
-            if self.submitted_moves == len(self.possible_moves) - 1:
-                self.active_player.task = None
-                self.log('chooses no new task')
-            else:
-                self.active_player.task = self.active_player.hand[self.submitted_moves].card
-                self.log(f'chooses new task {self.active_player.task.material.task} - {self.active_player.task}')
-                self.active_player.hand.pop(self.submitted_moves)
-            self.reset_possible_moves()
+        else:
+            self.moves = [encode_move(Action.RETURN, c.card) for c in self.active_player.hand]
+            self.number_of_moves_to_choose = len(self.active_player.hand) - 5
+            self.state = State.REDUCE_HAND
+
+    def handle_reduce_hand(self):
+        if isinstance(self.submitted_moves, int):
+            self.submitted_moves = [self.submitted_moves]
+        returned_cards = self.active_player.remove_hand_indices(self.submitted_moves)
+        self.reset_possible_moves()
+        self.deck.return_cards(returned_cards)
+        self.active_player.hand.hide()
+        self.emit(Event.RETURNS_CARDS, value=len(returned_cards))
+        self.state = State.MORNING_EFFECTS
+
+    def handle_morning_effects(self):
+        # TODO
+        self.emit(Event.MORNING_EFFECTS)
+        self.state = State.DISCARD_OLD_TASK
+
+    def handle_discard_old_task(self):
+        if self.active_player.initial_task:
+            self.floor.append(self.active_player.initial_task)
+            self.emit(Event.INITIAL_TASK_TO_FLOOR, self.active_player.initial_task)
+            self.active_player.initial_task = None
+        elif self.active_player.task:
+            self.floor.append(self.active_player.task)
+            self.emit(Event.PREVIOUS_TASK_TO_FLOOR, self.active_player.task)
+            self.active_player.task = None
+
+        if not self.active_player.hand:
+            self.emit(Event.NO_NEW_TASK)
             self.state = State.PERFORM_OPPONENT_TASK
-        elif self.state == State.PERFORM_OPPONENT_TASK:
-            self.print_state()
-            if self.opponents_with_tasks is None:
-                opponents_with_tasks = self.players[(self.active_player_ix+1):] + self.players[:self.active_player_ix]
-            if not self.opponents_with_tasks:
-                self.opponents_with_tasks = None
-                self.state = State.PERFORM_OWN_TASK
-            else:
-                opp = self.opponents_with_tasks.pop(0)
-                if opp.task:
-                    self.log(f"performs opponent {opp.name}'s {opp.task.material.task} task")
-                    self.current_task_to_perform = opp.task
-                    self.current_task_is_of_opponent = True
-                    self.state = State.PERFORM_TASK
-                    self.next_states.append(State.PERFORM_OPPONENT_TASK)
-                else:
-                    self.log(f'Opponent {opp.name} has no task', player_name=False)
+        else:
+            self.moves = [encode_move(Action.TASK, c.card) for c in self.active_player.hand]
+            self.moves.append(encode_move(Action.PRAY))
+            self.number_of_moves_to_choose = 1
+            self.state = State.CHOOSE_NEW_TASK
 
-        elif self.state == State.PERFORM_TASK:
-            task = self.current_task_to_perform
-            if not task:
-                self.log('prays')
-                self.active_player.waiting_area.append(self.deck.draw())
-                self.state = self.next_states.pop()
-            else:
-                if self.actions_to_perform is None:
-                    # TODO: Calc cover
-                    self.actions_to_perform = 1 + \
-                        sum(1 for helper in self.active_player.helpers
-                            if helper.material == task.material) + \
-                            self.active_player.covered_helpers[task.material]
-                    self.log(f'- {self.actions_to_perform} {task.material.task} action{"s" if self.actions_to_perform > 1 else ""} available')
-                    self.current_action_num = 1
-
-                if self.current_action_num > self.actions_to_perform:
-                    self.actions_to_perform = None
-                    self.state = self.next_states.pop()
-                else:
-                    self.instruction = f'Choose how to perform action #{self.current_action_num} of {self.actions_to_perform}'
-                    self.number_of_moves_to_choose = 1
-                    self.possible_moves_internal = []
-                    self.possible_moves = []
-
-                    # TODO: Check if works can be completed before allowing CRAFT or SMITH
-                    self.find_completeable_works()
-
-                    if task.material == PAPER and not self.active_player.craft_bench:
-                        self.log(f'cannot {task.material.task} with an empty craft bench')
-                    elif task.material in (STONE, CLAY) and not self.floor:
-                        self.log(f'cannot {task.material.task} with an empty floor')
-                    elif task.material == CLOTH and len(self.active_player.waiting_area) >= 5:
-                        self.possible_moves_internal.append(task.material)
-                        self.possible_moves.append(f'{task.material.task} (PASS since the waiting area is full)')
-                    elif task.material == METAL and not self.completeable_smith_works:
-                        # No log message as to not reveal information to opponents
-                        pass
-                    else:
-                        self.possible_moves_internal.append(task.material)
-                        self.possible_moves.append(f'{task.material.task} ({task.material.description})')
-
-                    # This test is disabled as it reveals information about hand to opponents
-                    # (even without the log, by the speed in which the fallback prayer is done)
-                    #
-                    # if not any(card.card.material == task.material for card in self.active_player.hand):
-                    #     self.log(f'cannot Craft {task.material.name} with no matching cards in hand')
-                    # else:
-
-                    if task.material in self.completeable_craft_works:
-                        self.possible_moves_internal.append('craft')
-                        self.possible_moves.append(f'Craft ({task.material.name})')
-
-                    self.possible_moves_internal.append('pray')
-                    self.possible_moves.append('Pray')
-                    self.state = State.PERFORM_ACTION
-                    # TODO: Disable auto-selection of 1 action because the
-                    # fast auto-pray may reveal that the player cannot smith.
-                    self.next_states.append(State.PERFORM_TASK)
-
-        elif self.state == State.PERFORM_ACTION:
-            action = self.possible_moves_internal[self.submitted_moves]
-            self.reset_possible_moves()
+    def handle_choose_new_task(self):
+        move = self.moves[self.submitted_moves]
+        if move_action(move) == Action.PRAY:
+            self.active_player.task = None
+            self.emit(Event.NO_NEW_TASK)
+        else:
+            self.active_player.task = move_card(move)
+            self.emit(Event.NEW_TASK, self.active_player.task)
+            self.active_player.remove_from_hand(self.active_player.task)
+        self.reset_possible_moves()
+        self.state = State.PERFORM_OPPONENT_TASK
 
-            if action == PAPER:
-                self.state = State.PERFORM_CLERK
-                self.instruction = 'Select a material from the craft bench to sell'
-                self.possible_moves = []
-                self.possible_moves.extend(self.active_player.craft_bench)
-                self.allow_cancel = True
-                self.number_of_moves_to_choose = 1
-                return
-            elif action == STONE:
-                self.state = State.PERFORM_MONK
-                self.instruction = 'Select a card from the floor to become a helper'
-                self.possible_moves = []
-                self.possible_moves.extend(self.floor)
-                self.allow_cancel = True
-                self.number_of_moves_to_choose = 1
-                return
-            elif action == CLOTH:
-                self.log('TODO: Tailor')
-                self.state = State.PERFORM_TAILOR
-                room_in_waiting_area = max(0, 5 - len(self.active_player.waiting_area))
-                hand_size = len(self.active_player.hand)
-                max_cards = min(room_in_waiting_area, hand_size)
-                self.instruction = f'Select 0–{max_cards} cards from your hand to return'
-                self.possible_moves = []
-                self.possible_moves.extend(self.active_player.hand)
-                self.allow_cancel = True
-                self.number_of_moves_to_choose = (0, max_cards)
-                return
-            elif action == CLAY:
-                self.state = State.PERFORM_POTTER
-                self.instruction = 'Select a card from the floor to collect in the craft bench'
-                self.possible_moves = []
-                self.possible_moves.extend(self.floor)
-                self.allow_cancel = True
-                self.number_of_moves_to_choose = 1
-                return
-            elif action == METAL:
-                self.state = State.PERFORM_SMITH
-                self.instruction = 'Select a card to smith'
-                hand_cards = [
-                    (i, c) for (i, c) in enumerate(self.active_player.hand)
-                    if c.card.material in self.completeable_smith_works
-                ]
-                self.possible_moves = [c for (i, c) in hand_cards]
-                self.possible_moves_internal = [i for (i, c) in hand_cards]
-                self.allow_cancel = True
-                self.number_of_moves_to_choose = 1
-                return
-            elif action == 'craft':
-                self.state = State.PERFORM_CRAFT
-                self.instruction = 'Select a card to craft'
-                self.possible_moves = [
-                    c for c in self.active_player.hand
-                    if c.card.material == self.current_task_to_perform.material
-                ]
-                self.allow_cancel = True
-                self.number_of_moves_to_choose = 1
-                return
-            elif action == 'pray':
-                self.log('prays')
-                self.active_player.waiting_area.append(self.deck.draw())
-                self.possible_moves = []
-                if self.current_action_num:
-                    self.current_action_num += 1
+    def handle_perform_opponent_task(self):
+        self.print_state()
+        if self.opponents_with_tasks is None:
+            self.opponents_with_tasks = self.players[(self.active_player_ix+1):] + self.players[:self.active_player_ix]
+        if not self.opponents_with_tasks:
+            self.opponents_with_tasks = None
+            self.state = State.PERFORM_OWN_TASK
+        else:
+            opp = self.opponents_with_tasks.pop(0)
+            if opp.task:
+                self.emit(Event.PERFORMS_OPPONENT_TASK, opp.task, self.players.index(opp))
+                self.current_task_to_perform = opp.task
+                self.current_task_is_of_opponent = True
+                self.state = State.PERFORM_TASK
+                self.next_states.append(State.PERFORM_OPPONENT_TASK)
             else:
-                raise Exception(f'Unknown action {action}')
-
-            self.state = self.next_states.pop()
-
-        elif self.state == State.PERFORM_CLERK:
-            if self.submitted_moves != -1:
-                card = self.active_player.craft_bench[self.submitted_moves]
-                self.active_player.sales.append(card)
-                self.active_player.craft_bench.pop(self.submitted_moves)
-                self.log(f'moves {card} from craft bench to sales')
-                if self.current_action_num:
-                    self.current_action_num += 1
-            self.reset_possible_moves()
-            self.state = self.next_states.pop()
+                self.emit(Event.OPPONENT_HAS_NO_TASK, value=self.players.index(opp))
 
-        elif self.state == State.PERFORM_MONK:
-            if self.submitted_moves != -1:
-                card = self.floor[self.submitted_moves]
-                self.active_player.helpers.append(card)
-                self.floor.pop(self.submitted_moves)
-                self.log(f'moves {card} from floor to helpers')
-                if self.current_action_num:
-                    self.current_action_num += 1
-            self.reset_possible_moves()
+    def handle_perform_task(self):
+        task = self.current_task_to_perform
+        if not task:
+            self.pray()
             self.state = self.next_states.pop()
-
-        elif self.state == State.PERFORM_TAILOR:
-            if self.submitted_moves != -1:
-                if not self.submitted_moves:
-                    self.log(f'returns 0 cards')
+        else:
+            if self.actions_to_perform is None:
+                self.actions_to_perform = 1 + \
+                    self.active_player.helper_count(task.material) + \
+                    self.active_player.covered_helper_count(task.material)
+                self.emit(Event.ACTIONS_AVAILABLE, task, self.actions_to_perform)
+                self.current_action_num = 1
+
+            if self.current_action_num > self.actions_to_perform:
+                self.actions_to_perform = None
+                self.state = self.next_states.pop()
+            else:
+                self.number_of_moves_to_choose = 1
+                self.moves = []
+
+                # TODO: Check if works can be completed before allowing CRAFT or SMITH
+                self.find_completeable_works()
+
+                if task.material == PAPER and not self.active_player.craft_bench:
+                    self.emit(Event.CANNOT_WITH_EMPTY_CRAFT_BENCH, task)
+                elif task.material in (STONE, CLAY) and not self.floor:
+                    self.emit(Event.CANNOT_WITH_EMPTY_FLOOR, task)
+                elif task.material == METAL and not self.completeable_smith_works:
+                    # No log message as to not reveal information to opponents
+                    pass
                 else:
-                    returned_cards = [self.active_player.hand[i].card for i in self.submitted_moves]
-                    self.active_player.hand = Hand(x for i, x in enumerate(self.active_player.hand) if i not in self.submitted_moves)
-                    self.deck.return_cards(returned_cards)
-                    self.active_player.hand.hide()
-                    self.log(f'returns {len(returned_cards)} card{"s" if len(returned_cards) > 1 else ""}')
-
-                cards_to_refill = max(0, 5 - len(self.active_player.hand) - len(self.active_player.waiting_area))
-                if cards_to_refill:
-                    self.log(f'draws {cards_to_refill} card{"s" if cards_to_refill > 1 else ""} into the waiting area')
-                    for _ in range(cards_to_refill):
-                        self.active_player.waiting_area.append(self.deck.draw())
-                if self.current_action_num:
-                    self.current_action_num += 1
-            self.reset_possible_moves()
-            self.state = self.next_states.pop()
+                    # With a full waiting area, Tailor is offered as a pass
+                    self.moves.append(encode_move(TASK_ACTIONS[task.material]))
+
+                # This test is disabled as it reveals information about hand to opponents
+                # (even without the log, by the speed in which the fallback prayer is done)
+                #
+                # if not any(card.card.material == task.material for card in self.active_player.hand):
+                #     self.log(f'cannot Craft {task.material.name} with no matching cards in hand')
+                # else:
+
+                if task.material in self.completeable_craft_works:
+                    self.moves.append(encode_move(Action.CRAFT))
+
+                self.moves.append(encode_move(Action.PRAY))
+                self.state = State.PERFORM_ACTION
+                # TODO: Disable auto-selection of 1 action because the
+                # fast auto-pray may reveal that the player cannot smith.
+                self.next_states.append(State.PERFORM_TASK)
+
+    def handle_perform_action(self):
+        action = move_action(self.moves[self.submitted_moves])
+        self.reset_possible_moves()
+
+        if action == Action.CLERK:
+            self.state = State.PERFORM_CLERK
+            self.moves = [encode_move(Action.SELL, c) for c in self.active_player.craft_bench]
+            self.allow_cancel = True
+            self.number_of_moves_to_choose = 1
+            return
+        elif action == Action.MONK:
+            self.state = State.PERFORM_MONK
+            self.moves = [encode_move(Action.HIRE, c) for c in self.floor]
+            self.allow_cancel = True
+            self.number_of_moves_to_choose = 1
+            return
+        elif action == Action.TAILOR:
+            self.emit(Event.TAILOR)
+            self.state = State.PERFORM_TAILOR
+            room_in_waiting_area = max(0, 5 - len(self.active_player.waiting_area))
+            hand_size = len(self.active_player.hand)
+            max_cards = min(room_in_waiting_area, hand_size)
+            self.moves = [encode_move(Action.RETURN, c.card) for c in self.active_player.hand]
+            self.allow_cancel = True
+            self.number_of_moves_to_choose = (0, max_cards)
+            return
+        elif action == Action.POTTER:
+            self.state = State.PERFORM_POTTER
+            self.moves = [encode_move(Action.COLLECT, c) for c in self.floor]
+            self.allow_cancel = True
+            self.number_of_moves_to_choose = 1
+            return
+        elif action == Action.SMITH:
+            self.state = State.PERFORM_SMITH
+            self.moves = [
+                encode_move(Action.SMITH_WORK, c.card) for c in self.active_player.hand
+                if c.card.material in self.completeable_smith_works
+            ]
+            self.allow_cancel = True
+            self.number_of_moves_to_choose = 1
+            return
+        elif action == Action.CRAFT:
+            self.state = State.PERFORM_CRAFT
+            self.moves = [
+                encode_move(Action.CRAFT_WORK, c.card) for c in self.active_player.hand
+                if c.card.material == self.current_task_to_perform.material
+            ]
+            self.allow_cancel = True
+            self.number_of_moves_to_choose = 1
+            return
+        elif action == Action.PRAY:
+            self.pray()
+            self.moves = []
+            if self.current_action_num:
+                self.current_action_num += 1
+        else:
+            raise Exception(f'Unknown action {action}')
 
-        elif self.state == State.PERFORM_POTTER:
-            if self.submitted_moves != -1:
-                card = self.floor[self.submitted_moves]
-                self.active_player.craft_bench.append(card)
-                self.floor.pop(self.submitted_moves)
-                self.log(f'moves {card} from floor to craft bench')
-                if self.current_action_num:
-                    self.current_action_num += 1
-            self.reset_possible_moves()
-            self.state = self.next_states.pop()
+        self.state = self.next_states.pop()
+
+    def handle_perform_clerk(self):
+        if self.submitted_moves != -1:
+            card = move_card(self.moves[self.submitted_moves])
+            self.active_player.add_card('sales', card)
+            self.active_player.remove_card('craft_bench', card)
+            self.emit(Event.SELLS, card)
+            if self.current_action_num:
+                self.current_action_num += 1
+        self.reset_possible_moves()
+        self.state = self.next_states.pop()
+
+    def handle_perform_monk(self):
+        if self.submitted_moves != -1:
+            card = move_card(self.moves[self.submitted_moves])
+            self.active_player.add_card('helpers', card)
+            self.floor.remove(card)
+            self.emit(Event.HIRES, card)
+            if self.current_action_num:
+                self.current_action_num += 1
+        self.reset_possible_moves()
+        self.state = self.next_states.pop()
 
-        elif self.state == State.PERFORM_SMITH:
-            if self.submitted_moves != -1:
-                card = self.active_player.hand.pop(self.possible_moves_internal[self.submitted_moves]).card
-                self.completed_work = card
-                ready_to_smith = False
-                if card.material.value - 1 <= 0:
+    def handle_perform_tailor(self):
+        if self.submitted_moves != -1:
+            if not self.submitted_moves:
+                self.emit(Event.RETURNS_CARDS, value=0)
+            else:
+                returned_cards = self.active_player.remove_hand_indices(self.submitted_moves)
+                self.deck.return_cards(returned_cards)
+                self.active_player.hand.hide()
+                self.emit(Event.RETURNS_CARDS, value=len(returned_cards))
+
+            cards_to_refill = max(0, 5 - len(self.active_player.hand) - len(self.active_player.waiting_area))
+            if cards_to_refill:
+                self.emit(Event.DRAWS_INTO_WAITING_AREA, value=cards_to_refill)
+                self.active_player.waiting_area.extend(self.deck.draw_cards(cards_to_refill))
+            if self.current_action_num:
+                self.current_action_num += 1
+        self.reset_possible_moves()
+        self.state = self.next_states.pop()
+
+    def handle_perform_potter(self):
+        if self.submitted_moves != -1:
+            card = move_card(self.moves[self.submitted_moves])
+            self.active_player.add_card('craft_bench', card)
+            self.floor.remove(card)
+            self.emit(Event.COLLECTS, card)
+            if self.current_action_num:
+                self.current_action_num += 1
+        self.reset_possible_moves()
+        self.state = self.next_states.pop()
+
+    def handle_perform_smith(self):
+        if self.submitted_moves != -1:
+            card = move_card(self.moves[self.submitted_moves])
+            self.active_player.remove_from_hand(card)
+            self.completed_work = card
+            ready_to_smith = False
+            if card.material.value - 1 <= 0:
+                ready_to_smith = True
+            else:
+                existing_support = [c.card for c in self.active_player.hand.revealed_cards if
+                        c.card.material == card.material]
+                if card.material.value - 1 <= len(existing_support):
                     ready_to_smith = True
                 else:
-                    existing_support = [c.card for c in self.active_player.hand.revealed_cards if
-                            c.card.material == card.material]
-                    if card.material.value - 1 <= len(existing_support):
-                        ready_to_smith = True
-                    else:
-                        self.reset_possible_moves()
-                        n = card.material.value - 1 - len(existing_support)
-                        self.instruction = f'Choose {n} card{"s" if n > 1 else ""} from your hand to reveal'
-                        # TODO: Allow cancel - need to return card to hand and delay revealing cards
-                        self.possible_moves = [c.card for c in self.active_player.hand.hidden_cards if c.card.material == card.material]
-                        self.number_of_moves_to_choose = n
-                        self.state = State.REVEAL_CARDS
-                        return
-
-                if ready_to_smith:
-                    if self.current_action_num:
-                        self.current_action_num += 1
                     self.reset_possible_moves()
-                    self.state = State.CHOOSE_COMPLETED_WORK_POS
+                    # TODO: Allow cancel - need to return card to hand and delay revealing cards
+                    self.moves = [
+                        encode_move(Action.REVEAL, c.card) for c in self.active_player.hand.hidden_cards
+                        if c.card.material == card.material
+                    ]
+                    self.number_of_moves_to_choose = card.material.value - 1 - len(existing_support)
+                    self.state = State.REVEAL_CARDS
                     return
-            self.reset_possible_moves()
-            self.state = self.next_states.pop()
-
-        elif self.state == State.REVEAL_CARDS:
-            hidden_cards = [c for c in self.active_player.hand.hidden_cards if
-                c.card.material == self.completed_work.material]
-            if not isinstance(self.submitted_moves, list):
-                self.submitted_moves = [self.submitted_moves]
-            for ix in self.submitted_moves:
-                hidden_cards[ix].visible = True
-                self.log(f'reveals {hidden_cards[ix].card}')
-            if self.current_action_num:
-                self.current_action_num += 1
-            self.reset_possible_moves()
-            self.state = State.CHOOSE_COMPLETED_WORK_POS
 
-
-        elif self.state == State.PERFORM_CRAFT:
-            if self.submitted_moves != -1:
-                self.completed_work = self.active_player.hand.pop(self.submitted_moves).card
+            if ready_to_smith:
                 if self.current_action_num:
                     self.current_action_num += 1
                 self.reset_possible_moves()
                 self.state = State.CHOOSE_COMPLETED_WORK_POS
                 return
+        self.reset_possible_moves()
+        self.state = self.next_states.pop()
+
+    def handle_reveal_cards(self):
+        if not isinstance(self.submitted_moves, list):
+            self.submitted_moves = [self.submitted_moves]
+        hand = self.active_player.hand
+        for ix in self.submitted_moves:
+            card = move_card(self.moves[ix])
+            hand[hand.index_of(card)].visible = True
+            self.emit(Event.REVEALS, card)
+        if self.current_action_num:
+            self.current_action_num += 1
+        self.reset_possible_moves()
+        self.state = State.CHOOSE_COMPLETED_WORK_POS
+
+    def handle_perform_craft(self):
+        if self.submitted_moves != -1:
+            self.completed_work = move_card(self.moves[self.submitted_moves])
+            self.active_player.remove_from_hand(self.completed_work)
+            if self.current_action_num:
+                self.current_action_num += 1
             self.reset_possible_moves()
+            self.state = State.CHOOSE_COMPLETED_WORK_POS
+            return
+        self.reset_possible_moves()
+        self.state = self.next_states.pop()
+
+    def handle_choose_completed_work_pos(self):
+        # TODO: Allow cancel (if possible) - will need to delay actually revealing cards
+        self.moves = [encode_move(Action.GALLERY), encode_move(Action.GIFT_SHOP)]
+        self.number_of_moves_to_choose = 1
+        self.state = State.PLACE_COMPLETED_WORK
+
+    def handle_place_completed_work(self):
+        wing = 'gallery' if move_action(self.moves[self.submitted_moves]) == Action.GALLERY else 'gift_shop'
+        target_wing = getattr(self.active_player, wing)
+        self.reset_possible_moves()
+        self.active_player.add_card(wing, self.completed_work)
+        self.completed_work = None
+        self.print_state()
+        if len(target_wing) == 5:
+            self.emit(Event.WING_FULL, value=int(wing == 'gift_shop'))
+            self.state = State.GAME_OVER
+        else:
             self.state = self.next_states.pop()
 
-        elif self.state == State.CHOOSE_COMPLETED_WORK_POS:
-            # TODO: Allow cancel (if possible) - will need to delay actually revealing cards
-            self.instruction = f'Choose where to place completed work {self.completed_work}'
-            self.possible_moves = ['Gallery', 'Gift Shop']
-            self.number_of_moves_to_choose = 1
-            self.state = State.PLACE_COMPLETED_WORK
-
-        elif self.state == State.PLACE_COMPLETED_WORK:
-            target_wing = self.active_player.gallery if self.submitted_moves == 0 \
-                     else self.active_player.gift_shop
-            self.reset_possible_moves()
-            target_wing.append(self.completed_work)
-            self.active_player.calculate_cover()
-            self.completed_work = None
-            if len(target_wing) == 5:
-                self.log(f'{"Gallery" if self.submitted_moves == 0 else "Gift Shop"} has 5 works. Game over.')
-                self.state = State.GAME_OVER
-            self.print_state()
-            self.state = self.next_states.pop()
-
-        elif self.state == State.PERFORM_OWN_TASK:
-            if self.active_player.task:
-                self.log(f'performs own {self.active_player.task.material.task} task')
-            else:
-                self.log('performs own missing task')
-            self.current_task_to_perform = self.active_player.task
-            self.current_task_is_of_opponent = False
-            self.state = State.PERFORM_TASK
-            self.next_states.append(State.NIGHT_EFFECTS)
-
-        elif self.state == State.NIGHT_EFFECTS:
-            # TODO
-            self.log('TODO: night effects', player_name=False)
-            self.state = State.DRAW_WAITING_AREA
-        elif self.state == State.DRAW_WAITING_AREA:
-            if self.active_player.waiting_area:
-                waiting_area_size = len(self.active_player.waiting_area)
-                self.log(f'draws {waiting_area_size} card{"s" if waiting_area_size > 1 else ""} from the waiting area')
-                self.active_player.hand.add_to_hand(self.active_player.waiting_area)
-                self.active_player.waiting_area = []
-            self.active_player_ix = (self.active_player_ix + 1) % len(self.players)
-            if self.active_player_ix == self.first_player_ix:
-                self.turn_number += 1
-            self.state = State.CHECK_HAND_SIZE
-            self.print_state()
+    def handle_perform_own_task(self):
+        if self.active_player.task:
+            self.emit(Event.PERFORMS_OWN_TASK, self.active_player.task)
         else:
-            raise Exception(f'Unknown state {self.state}')
+            self.emit(Event.PERFORMS_OWN_TASK)
+        self.current_task_to_perform = self.active_player.task
+        self.current_task_is_of_opponent = False
+        self.state = State.PERFORM_TASK
+        self.next_states.append(State.NIGHT_EFFECTS)
+
+    def handle_night_effects(self):
+        # TODO
+        self.emit(Event.NIGHT_EFFECTS)
+        self.state = State.DRAW_WAITING_AREA
+
+    def handle_draw_waiting_area(self):
+        if self.active_player.waiting_area:
+            waiting_area_size = len(self.active_player.waiting_area)
+            self.emit(Event.DRAWS_FROM_WAITING_AREA, value=waiting_area_size)
+            self.active_player.add_to_hand(self.active_player.waiting_area)
+            self.active_player.waiting_area.clear()
+        self.active_player_ix = (self.active_player_ix + 1) % len(self.players)
+        if self.active_player_ix == self.first_player_ix:
+            self.turn_number += 1
+        self.state = State.CHECK_HAND_SIZE
+        self.print_state()
 
     def print_state(self):
+        if not self.verbose:
+            return
+        print()
+        for line in self.format_view(self.active_player_ix):
+            print(line)
         print()
-        print(f'Turn {self.turn_number}, {self.active_player.name} active')
-        print(f'Deck: {len(self.deck)} card{"s" if len(self.deck) > 1 else ""}')
-        print(f'Floor: {self.floor}')
+
+    def format_view(self, viewer_ix):
+        # The table as seen by one player: other hands show only revealed cards
+        lines = [
+            f'Turn {self.turn_number}, {self.active_player.name} active',
+            f'Deck: {len(self.deck)} card{"s" if len(self.deck) > 1 else ""}',
+            f'Floor: {self.floor}',
+        ]
         for i, p in enumerate(self.players):
-            print(f'Player {i+1}')
-            print(f'\tHand: {p.hand.format_hand(i == self.active_player_ix)}')
+            lines.append(f'Player {i+1}')
+            lines.append(f'\tHand: {p.hand.format_hand(i == viewer_ix)}')
             if p.initial_task:
-                print('\tTask: Hidden')
+                lines.append('\tTask: Hidden')
             elif p.task:
-                print(f'\tTask: {p.task.material.task if p.task else "None"} - {p.task}')
+                lines.append(f'\tTask: {p.task.material.task if p.task else "None"} - {p.task}')
             else:
-                print('\tTask: None')
+                lines.append('\tTask: None')
             if p.gallery:
-                print(f'\tGallery: {p.gallery}')
+                lines.append(f'\tGallery: {p.gallery}')
             if p.gift_shop:
-                print(f'\tGift Shop: {p.gift_shop}')
+                lines.append(f'\tGift Shop: {p.gift_shop}')
             if p.helpers:
-                print(f'\tHelpers: {p.helpers}')
+                lines.append(f'\tHelpers: {p.helpers}')
             if p.craft_bench:
-                print(f'\tCraft Bench: {p.craft_bench}')
+                lines.append(f'\tCraft Bench: {p.craft_bench}')
             if p.sales:
-                print(f'\tSales: {p.sales}')
+                lines.append(f'\tSales: {p.sales}')
             if p.waiting_area:
-                print(f'Waiting Area: {len(p.waiting_area)}')
-        print()
+                lines.append(f'Waiting Area: {len(p.waiting_area)}')
+        return lines
+
+STATE_HANDLERS = {
+    State.CHECK_HAND_SIZE: Game.handle_check_hand_size,
+    State.REDUCE_HAND: Game.handle_reduce_hand,
+    State.MORNING_EFFECTS: Game.handle_morning_effects,
+    State.DISCARD_OLD_TASK: Game.handle_discard_old_task,
+    State.CHOOSE_NEW_TASK: Game.handle_choose_new_task,
+    State.PERFORM_OPPONENT_TASK: Game.handle_perform_opponent_task,
+    State.PERFORM_TASK: Game.handle_perform_task,
+    State.PERFORM_ACTION: Game.handle_perform_action,
+    State.PERFORM_CLERK: Game.handle_perform_clerk,
+    State.PERFORM_MONK: Game.handle_perform_monk,
+    State.PERFORM_TAILOR: Game.handle_perform_tailor,
+    State.PERFORM_POTTER: Game.handle_perform_potter,
+    State.PERFORM_SMITH: Game.handle_perform_smith,
+    State.REVEAL_CARDS: Game.handle_reveal_cards,
+    State.PERFORM_CRAFT: Game.handle_perform_craft,
+    State.CHOOSE_COMPLETED_WORK_POS: Game.handle_choose_completed_work_pos,
+    State.PLACE_COMPLETED_WORK: Game.handle_place_completed_work,
+    State.PERFORM_OWN_TASK: Game.handle_perform_own_task,
+    State.NIGHT_EFFECTS: Game.handle_night_effects,
+    State.DRAW_WAITING_AREA: Game.handle_draw_waiting_area,
+}
+
+
+def rewards(game):
+    # Per seat, in [0, 1]: the score against 30 alone, or else the margin
+    # over the best other seat
+    scores = [p.score for p in game.players]
+    if len(scores) == 1:
+        return [min(1.0, scores[0] / 30)]
+    result = []
+    for i, score in enumerate(scores):
+        best_other = max(s for j, s in enumerate(scores) if j != i)
+        result.append(0.5 + 0.5 * math.tanh((score - best_other) / 5))
+    return result
+
+
+def render_move(game, move):
+    action = move_action(move)
+    card = move_card(move)
+    if action == Action.TASK:
+        return f'{card.material.task} ({card.material.description}) - {card}'
+    elif action == Action.PRAY:
+        return 'Pray'
+    elif action in TASK_ACTIONS.values():
+        material = game.current_task_to_perform.material
+        if action == Action.TAILOR and len(game.active_player.waiting_area) >= 5:
+            return f'{material.task} (PASS since the waiting area is full)'
+        return f'{material.task} ({material.description})'
+    elif action == Action.CRAFT:
+        return f'Craft ({game.current_task_to_perform.material.name})'
+    elif action == Action.GALLERY:
+        return 'Gallery'
+    elif action == Action.GIFT_SHOP:
+        return 'Gift Shop'
+    elif action in HAND_CARD_ACTIONS:
+        hand = game.active_player.hand
+        return repr(hand[hand.index_of(card)])
+    else:
+        return repr(card)
+
+
+INSTRUCTIONS = {
+    State.CHOOSE_NEW_TASK: 'Choose task',
+    State.PERFORM_CLERK: 'Select a material from the craft bench to sell',
+    State.PERFORM_MONK: 'Select a card from the floor to become a helper',
+    State.PERFORM_POTTER: 'Select a card from the floor to collect in the craft bench',
+    State.PERFORM_SMITH: 'Select a card to smith',
+    State.PERFORM_CRAFT: 'Select a card to craft',
+}
+
+
+def render_instruction(game):
+    if game.state in INSTRUCTIONS:
+        return INSTRUCTIONS[game.state]
+    n = game.number_of_moves_to_choose
+    if game.state == State.REDUCE_HAND:
+        return f'Choose {n} card{"s" if n > 1 else ""} from your hand to return'
+    elif game.state == State.PERFORM_ACTION:
+        return f'Choose how to perform action #{game.current_action_num} of {game.actions_to_perform}'
+    elif game.state == State.PERFORM_TAILOR:
+        return f'Select 0–{n[1]} cards from your hand to return'
+    elif game.state == State.REVEAL_CARDS:
+        return f'Choose {n} card{"s" if n > 1 else ""} from your hand to reveal'
+    elif game.state == State.PLACE_COMPLETED_WORK:
+        return f'Choose where to place completed work {game.completed_work}'
+    return None
+
 
 if __name__ == '__main__':
     game = Game()
@@ -0,0 +1,149 @@
+import numpy as np
+
+from mottainai import CARDS, MATERIALS, State
+
+# Fixed-size feature vectors for many games at once, written into a float32
+# buffer the caller owns. Everything is from one observer's point of view:
+# seats are ordered from the observer in turn order, and only the
+# observer's hidden hand cards are shown. Card planes are one-hot over card
+# ids 1..54 and come from the zones' bitmasks, so no HandCard is visited.
+#
+# Layout of one observation:
+#   card planes     the floor, then SEAT_PLANES for each seat
+#   seat features   SEAT_FEATURES, material counts per seat plane, covered
+#                   helpers and covered sales value per material
+#   game features   GAME_FEATURES, floor material counts, State one-hot and
+#                   the material of the task being performed
+
+CARD_IDS = len(CARDS)
+SEAT_PLANES = ('hand_visible', 'hand_hidden', 'task', 'craft_bench', 'helpers', 'sales', 'gallery', 'gift_shop')
+SEAT_FEATURES = ('hand_size', 'waiting_area_size', 'has_initial_task', 'is_active', 'score')
+GAME_FEATURES = ('deck_size', 'turn_number', 'task_is_of_opponent', 'actions_to_perform', 'current_action_num')
+STATES = list(State)
+STATE_INDEX = {state: i for i, state in enumerate(STATES)}
+MATERIAL_COUNT = len(MATERIALS)
+
+# Card id - 1 to material index and value
+MATERIAL_ONE_HOT = np.zeros((CARD_IDS, MATERIAL_COUNT), np.float32)
+for c in CARDS:
+    MATERIAL_ONE_HOT[c.id - 1, c.material.id - 1] = 1
+MATERIAL_VALUES = np.array([m.value for m in MATERIALS], np.float32)
+
+PLANE = {name: i for i, name in enumerate(SEAT_PLANES)}
+
+
+class ObservationEncoder:
+    def __init__(self, player_count, batch_size=1024):
+        self.player_count = player_count
+        self.batch_size = batch_size
+        self.planes = 1 + len(SEAT_PLANES) * player_count
+        self.card_size = self.planes * CARD_IDS
+        self.seat_size = len(SEAT_FEATURES) + (len(SEAT_PLANES) + 2) * MATERIAL_COUNT
+        self.seat_offset = self.card_size
+        self.game_offset = self.seat_offset + self.seat_size * player_count
+        self.state_offset = self.game_offset + len(GAME_FEATURES) + MATERIAL_COUNT
+        self.task_offset = self.state_offset + len(STATES)
+        self.size = self.task_offset + MATERIAL_COUNT
+        # Scratch space reused for every batch
+        self.masks = np.zeros((batch_size, self.planes), np.uint64)
+        self.seat_values = np.zeros((batch_size, player_count, len(SEAT_FEATURES)), np.float32)
+        self.game_values = np.zeros((batch_size, len(GAME_FEATURES)), np.float32)
+        self.states = np.zeros(batch_size, np.int64)
+        self.tasks = np.zeros(batch_size, np.int64)
+
+    def encode(self, games, out, observers=None):
+        # out must be a float32 array of shape (len(games), self.size).
+        # observers defaults to each game's active player
+        if out.shape != (len(games), self.size) or out.dtype != np.float32:
+            raise ValueError(f'Expected a float32 buffer of shape ({len(games)}, {self.size})')
+        for start in range(0, len(games), self.batch_size):
+            stop = min(start + self.batch_size, len(games))
+            self.encode_batch(
+                games[start:stop], out[start:stop],
+                None if observers is None else observers[start:stop])
+        return out
+
+    def gather(self, games, observers):
+        # The only per-game Python work: reading ints off each game
+        n = len(games)
+        player_count = self.player_count
+        masks = []
+        seats = []
+        values = []
+        for i, game in enumerate(games):
+            observer = game.active_player_ix if observers is None else observers[i]
+            masks.append(game.floor.mask)
+            for s in range(player_count):
+                ix = (observer + s) % player_count
+                p = game.players[ix]
+                hand = p.hand.mask
+                visible = p.hand.visible_mask
+                masks += [
+                    visible,
+                    hand & ~visible if s == 0 else 0,
+                    1 << p.task.id if p.task else 0,
+                    p.craft_bench.mask,
+                    p.helpers.mask,
+                    p.sales.mask,
+                    p.gallery.mask,
+                    p.gift_shop.mask,
+                ]
+                seats += [
+                    hand.bit_count(),
+                    len(p.waiting_area),
+                    p.initial_task is not None,
+                    ix == game.active_player_ix,
+                    0,
+                ]
+            task = game.current_task_to_perform
+            values += [
+                len(game.deck),
+                game.turn_number,
+                game.current_task_is_of_opponent,
+                game.actions_to_perform or 0,
+                game.current_action_num or 0,
+            ]
+            self.states[i] = STATE_INDEX[game.state]
+            self.tasks[i] = task.material.id - 1 if task else -1
+        self.masks[:n].flat = masks
+        self.seat_values[:n].flat = seats
+        self.game_values[:n].flat = values
+
+    def encode_batch(self, games, out, observers):
+        n = len(games)
+        self.gather(games, observers)
+
+        bits = np.unpackbits(self.masks[:n].view(np.uint8), axis=1, bitorder='little')
+        bits.shape = (n, self.planes, 64)
+        cards = out[:, :self.card_size]
+        cards.shape = (n, self.planes, CARD_IDS)
+        cards[:] = bits[:, :, 1:CARD_IDS + 1]
+
+        counts = cards @ MATERIAL_ONE_HOT
+        seat_counts = counts[:, 1:].reshape(n, self.player_count, len(SEAT_PLANES), MATERIAL_COUNT)
+        helpers = seat_counts[:, :, PLANE['helpers']]
+        gallery = seat_counts[:, :, PLANE['gallery']]
+        sales = seat_counts[:, :, PLANE['sales']]
+        gift_shop = seat_counts[:, :, PLANE['gift_shop']]
+        covered_helpers = np.where(helpers <= gallery * MATERIAL_VALUES, helpers, 0)
+        covered_sales = np.where(sales <= gift_shop * MATERIAL_VALUES, sales * MATERIAL_VALUES, 0)
+        score = ((gallery + gift_shop) @ MATERIAL_VALUES) + covered_sales.sum(2)
+        self.seat_values[:n, :, SEAT_FEATURES.index('score')] = score
+
+        seat = out[:, self.seat_offset:self.game_offset]
+        seat.shape = (n, self.player_count, self.seat_size)
+        end = len(SEAT_FEATURES)
+        seat[:, :, :end] = self.seat_values[:n]
+        seat[:, :, end:end + len(SEAT_PLANES) * MATERIAL_COUNT] = seat_counts.reshape(n, self.player_count, -1)
+        end += len(SEAT_PLANES) * MATERIAL_COUNT
+        seat[:, :, end:end + MATERIAL_COUNT] = covered_helpers
+        seat[:, :, end + MATERIAL_COUNT:] = covered_sales
+
+        end = self.game_offset + len(GAME_FEATURES)
+        out[:, self.game_offset:end] = self.game_values[:n]
+        out[:, end:self.state_offset] = counts[:, 0]
+        out[:, self.state_offset:] = 0
+        rows = np.arange(n)
+        out[rows, self.state_offset + self.states[:n]] = 1
+        tasks = self.tasks[:n]
+        out[rows[tasks >= 0], self.task_offset + tasks[tasks >= 0]] = 1
@@ -0,0 +1,164 @@
+from time import perf_counter_ns
+
+from mottainai import Game, State
+
+# Per-state instrumentation. Profiler.attach(game) switches the game to a
+# Game subclass whose handle_state, step and hot helpers time themselves,
+# so unprofiled games run exactly the same code as before and pay nothing.
+# Clones are plain Games again.
+
+# Timings go into a log-scale histogram with four buckets per octave, so
+# percentiles are within about 20% and memory stays fixed however long the
+# run is
+BUCKETS = 256
+
+
+def bucket(ns):
+    n = ns.bit_length()
+    if n < 3:
+        return ns
+    return (n - 1) * 4 + ((ns >> (n - 3)) & 3)
+
+
+def bucket_value(b):
+    if b < 4:
+        return b
+    octave, step = divmod(b, 4)
+    return (4 + step) << (octave - 2)
+
+
+class Timing:
+    __slots__ = ('count', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        self.buckets[bucket(ns)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for b, n in enumerate(other.buckets):
+            self.buckets[b] += n
+
+    def percentile(self, p):
+        target = p * self.count
+        seen = 0
+        for b, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return bucket_value(b)
+        return 0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_ns': self.total,
+            'mean_ns': self.total // self.count if self.count else 0,
+            'p50_ns': self.percentile(0.5),
+            'p90_ns': self.percentile(0.9),
+            'p99_ns': self.percentile(0.99),
+        }
+
+
+class Profiler:
+    # One profiler can be attached to any number of games and sums over all
+    # of them. states times each handle_state call by the state it handled,
+    # decisions times agents' choose() by the state they decided in, and
+    # functions times the helpers states call into
+    def __init__(self):
+        self.states = {state: Timing() for state in State}
+        self.decisions = {state: Timing() for state in State}
+        self.functions = {name: Timing() for name in ('find_completeable_works', 'pray', 'emit', 'print_state')}
+        self.game_class = self.make_game_class()
+
+    def attach(self, game):
+        game.__class__ = self.game_class
+        return game
+
+    @staticmethod
+    def detach(game):
+        game.__class__ = Game
+        return game
+
+    def make_game_class(self):
+        states = self.states
+        decisions = self.decisions
+        functions = self.functions
+
+        def timed(name):
+            timing = functions[name]
+            method = getattr(Game, name)
+
+            def wrapper(self, *args, **kwargs):
+                start = perf_counter_ns()
+                result = method(self, *args, **kwargs)
+                timing.add(perf_counter_ns() - start)
+                return result
+            return wrapper
+
+        class ProfiledGame(Game):
+            __slots__ = ()
+
+            def handle_state(self):
+                timing = states[self.state]
+                start = perf_counter_ns()
+                Game.handle_state(self)
+                timing.add(perf_counter_ns() - start)
+
+            # Same as Game.step, with the agent's choice timed
+            def step(self):
+                if self.moves:
+                    start = perf_counter_ns()
+                    moves = self.agents[self.active_player_ix].choose(self)
+                    decisions[self.state].add(perf_counter_ns() - start)
+                else:
+                    moves = None
+                if self.verbose:
+                    print(f'State is {self.state}')
+                self.apply(moves)
+
+            find_completeable_works = timed('find_completeable_works')
+            pray = timed('pray')
+            emit = timed('emit')
+            print_state = timed('print_state')
+
+        return ProfiledGame
+
+    def merge(self, other):
+        for mine, theirs in ((self.states, other.states), (self.decisions, other.decisions),
+                             (self.functions, other.functions)):
+            for name, timing in theirs.items():
+                mine[name].merge(timing)
+
+    def as_dict(self):
+        return {
+            'states': {s.name: t.as_dict() for s, t in self.states.items() if t.count},
+            'decisions': {s.name: t.as_dict() for s, t in self.decisions.items() if t.count},
+            'functions': {name: t.as_dict() for name, t in self.functions.items() if t.count},
+        }
+
+    def report(self):
+        total = sum(t.total for t in self.states.values()) or 1
+        lines = []
+        for title, timings in (('State', self.states), ('Decision in state', self.decisions),
+                               ('Function', self.functions)):
+            rows = sorted(
+                ((getattr(name, 'name', name), t) for name, t in timings.items() if t.count),
+                key=lambda row: -row[1].total)
+            if not rows:
+                continue
+            lines.append(f'{title:<28} {"calls":>10} {"total ms":>10} {"share":>6} '
+                         f'{"mean us":>8} {"p50 us":>8} {"p90 us":>8} {"p99 us":>8}')
+            for name, t in rows:
+                lines.append(
+                    f'{name:<28} {t.count:>10} {t.total / 1e6:>10.1f} {t.total / total:>6.1%} '
+                    f'{t.total / t.count / 1e3:>8.2f} {t.percentile(0.5) / 1e3:>8.2f} '
+                    f'{t.percentile(0.9) / 1e3:>8.2f} {t.percentile(0.99) / 1e3:>8.2f}')
+            lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import argparse
+import struct
+import sys
+from array import array
+
+from mottainai import CARD_BY_ID, Game, ListBackend
+from cardset import BitsetBackend
+from zobrist import ZobristBackend
+
+# A record is the header, the deck order as one card id byte per card, top
+# card first, and then one entry per decision, that is per apply() call
+# with moves to choose from:
+#   0xff                    no move
+#   0xfe                    cancel (-1)
+#   0x80 | n, i1 .. in      a list of n move indices
+#   i                       a single move index, below 0x80
+# Steps that need no input are left out, as step_until_decision() runs them
+# again. Game files are a sequence of records, each prefixed by its byte
+# length.
+MAGIC = b'MOTR'
+VERSION = 2
+HEADER = struct.Struct('<4sBBB')
+LENGTH = struct.Struct('<I')
+NO_MOVE = 0xff
+CANCEL = 0xfe
+MOVE_LIST = 0x80
+
+
+class GameRecord:
+    def __init__(self, player_count=0, deck=b'', moves=b''):
+        self.player_count = player_count
+        self.deck = bytes(deck)
+        self.moves = bytearray(moves)
+        # Where each entry starts, so undo() can drop the last one
+        self.starts = None
+
+    def start(self, player_count, cards):
+        self.player_count = player_count
+        self.deck = bytes(c.id for c in cards)
+        self.moves.clear()
+        self.starts = array('I')
+
+    def append(self, moves):
+        self.starts.append(len(self.moves))
+        if moves is None:
+            self.moves.append(NO_MOVE)
+        elif moves == -1:
+            self.moves.append(CANCEL)
+        elif isinstance(moves, int):
+            self.moves.append(moves)
+        else:
+            self.moves.append(MOVE_LIST | len(moves))
+            self.moves.extend(moves)
+
+    def pop(self):
+        del self.moves[self.starts.pop():]
+
+    def cards(self):
+        return [CARD_BY_ID[i] for i in self.deck]
+
+    def decode_moves(self):
+        data = self.moves
+        moves = []
+        i = 0
+        while i < len(data):
+            b = data[i]
+            i += 1
+            if b == NO_MOVE:
+                moves.append(None)
+            elif b == CANCEL:
+                moves.append(-1)
+            elif b & MOVE_LIST:
+                n = b & ~MOVE_LIST
+                moves.append(list(data[i:i + n]))
+                i += n
+            else:
+                moves.append(b)
+        return moves
+
+    def to_bytes(self):
+        return HEADER.pack(MAGIC, VERSION, self.player_count, len(self.deck)) + self.deck + self.moves
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, player_count, deck_size = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Not a version {VERSION} game record')
+        start = HEADER.size
+        return cls(player_count, data[start:start + deck_size], data[start + deck_size:])
+
+
+def write_record(f, data):
+    # data is GameRecord.to_bytes(), which is what worker processes send back
+    f.write(LENGTH.pack(len(data)))
+    f.write(data)
+
+
+def read_records(f):
+    while True:
+        prefix = f.read(LENGTH.size)
+        if not prefix:
+            return
+        length, = LENGTH.unpack(prefix)
+        yield GameRecord.from_bytes(f.read(length))
+
+
+class Replayer:
+    # Rebuilds the game after any number of decisions, run on to the next
+    # decision or the end. A clone is kept every snapshot_interval
+    # decisions, so a seek replays at most that many.
+    # Move indices depend on zone order, so replay with the backend the game
+    # was recorded with.
+    def __init__(self, record, backend=ListBackend, snapshot_interval=64):
+        self.moves = record.decode_moves()
+        self.snapshot_interval = snapshot_interval
+        game = Game(verbose=False, backend=backend)
+        game.deal(record.player_count, record.cards())
+        self.snapshots = [game]
+
+    def __len__(self):
+        return len(self.moves)
+
+    def seek(self, n):
+        if not 0 <= n <= len(self.moves):
+            raise IndexError(f'move {n} out of range')
+        interval = self.snapshot_interval
+        while len(self.snapshots) <= n // interval:
+            start = (len(self.snapshots) - 1) * interval
+            game = self.snapshots[-1].clone()
+            for moves in self.moves[start:start + interval]:
+                game.step_until_decision()
+                game.apply(moves)
+            self.snapshots.append(game)
+        start = n // interval * interval
+        game = self.snapshots[n // interval].clone()
+        for moves in self.moves[start:n]:
+            game.step_until_decision()
+            game.apply(moves)
+        game.step_until_decision()
+        return game
+
+    def final(self):
+        return self.seek(len(self.moves))
+
+
+BACKENDS = {
+    'list': ListBackend,
+    'bitset': BitsetBackend,
+    'zobrist': ZobristBackend,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect recorded games')
+    parser.add_argument('file')
+    parser.add_argument('-g', '--game', type=int, help='show a single game')
+    parser.add_argument('-m', '--move', type=int, help='with --game, show the state after this many decisions')
+    parser.add_argument('-b', '--backend', choices=sorted(BACKENDS), default='list',
+                        help='the backend the games were recorded with')
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as f:
+        for i, record in enumerate(read_records(f)):
+            if args.game is not None and i != args.game:
+                continue
+            replayer = Replayer(record, BACKENDS[args.backend])
+            if args.game is None:
+                game = replayer.final()
+                scores = [p.score for p in game.players]
+                print(f'{i}: {len(replayer)} decisions, {game.turn_number} turns, scores {scores}')
+                continue
+            game = replayer.seek(len(replayer) if args.move is None else args.move)
+            game.verbose = True
+            game.print_state()
+            return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import hashlib
+import os
+from random import Random
+
+# A counter-based generator: the n-th 64-bit output is a hash of (key, n),
+# the SplitMix64 sequence. The whole state is two ints, so copying is O(1),
+# jump(n) skips n outputs in O(1), and fork(stream) derives an independent
+# generator, e.g. one per game of a batch or per search determinization.
+# The sampling methods are random.Random's own, which only need random()
+# and getrandbits().
+
+MASK64 = (1 << 64) - 1
+GAMMA = 0x9e3779b97f4a7c15
+
+
+def mix64(z):
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9 & MASK64
+    z = (z ^ (z >> 27)) * 0x94d049bb133111eb & MASK64
+    return z ^ (z >> 31)
+
+
+class CounterRNG:
+    __slots__ = ('key', 'counter')
+
+    def __init__(self, seed=None):
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        # Any seed random.Random takes; ints of up to 64 bits are used as is
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), 'little')
+        elif not isinstance(seed, int) or not 0 <= seed <= MASK64:
+            seed = int.from_bytes(hashlib.sha512(repr(seed).encode()).digest()[:8], 'little')
+        self.key = mix64(seed)
+        self.counter = 0
+
+    def next64(self):
+        self.counter += 1
+        return mix64((self.key + self.counter * GAMMA) & MASK64)
+
+    def getrandbits(self, k):
+        if k <= 64:
+            if k < 0:
+                raise ValueError('number of bits must be non-negative')
+            return self.next64() >> (64 - k)
+        bits = 0
+        for shift in range(0, k, 64):
+            bits |= self.next64() << shift
+        return bits & ((1 << k) - 1)
+
+    def random(self):
+        return (self.next64() >> 11) * (1.0 / (1 << 53))
+
+    def jump(self, n):
+        # Skips the next n 64-bit outputs
+        self.counter += n
+
+    def fork(self, stream=0):
+        # A new generator that depends on this one's key and position and
+        # on stream, and shares no outputs with it in practice
+        other = CounterRNG.__new__(CounterRNG)
+        other.key = mix64(self.key ^ mix64((self.counter + stream * GAMMA + 1) & MASK64))
+        other.counter = 0
+        return other
+
+    def copy(self):
+        other = CounterRNG.__new__(CounterRNG)
+        other.key = self.key
+        other.counter = self.counter
+        return other
+
+    __copy__ = copy
+
+    def getstate(self):
+        return self.key, self.counter
+
+    def setstate(self, state):
+        self.key, self.counter = state
+
+    def _randbelow(self, n):
+        # Multiply-shift instead of rejection sampling: the bias is below
+        # n / 2**64
+        if n > MASK64:
+            return self._randbelow_with_getrandbits(n)
+        self.counter += 1
+        return mix64((self.key + self.counter * GAMMA) & MASK64) * n >> 64
+
+    _randbelow_with_getrandbits = Random._randbelow_with_getrandbits
+    randrange = Random.randrange
+    randint = Random.randint
+    choice = Random.choice
+    choices = Random.choices
+    sample = Random.sample
+    shuffle = Random.shuffle
+    uniform = Random.uniform
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import sys
+
+from mottainai import (
+    Game, State, format_event, forced_choice, format_options, parse_choice,
+)
+from rng import CounterRNG
+
+# Line based protocol over TCP, e.g. with `nc localhost 7777`. Players are
+# seated in arrival order and a table starts once it is full. The server
+# sends views, event lines and numbered options; the player answers a
+# prompt with the same input prompt_choice accepts.
+
+
+class Seat:
+    __slots__ = ('reader', 'writer', 'name', 'watcher')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.name = None
+        self.watcher = None
+
+    def send(self, lines):
+        self.writer.write(''.join(f'{line}\n' for line in lines).encode())
+
+
+class TableSink:
+    # Events are public, so every seat gets every event line
+    __slots__ = ('seats',)
+
+    def __init__(self, seats):
+        self.seats = seats
+
+    def __call__(self, kind, player, card, value):
+        line = f'LOG: {format_event(kind, player, card, value)}.\n'.encode()
+        for seat in self.seats:
+            seat.writer.write(line)
+
+
+class Disconnected(Exception):
+    pass
+
+
+class TimedOut(Exception):
+    pass
+
+
+async def ask(seat, game, timeout=None):
+    # Only the decision's player sees the options and their own hand
+    option_count = len(game.moves)
+    n = game.number_of_moves_to_choose
+    forced = forced_choice(option_count, n, game.allow_cancel)
+    if forced is not None:
+        return forced
+    seat.send([''] + game.format_view(game.active_player_ix) + [''])
+    seat.send([f'{seat.name} - {game.instruction}:'] + format_options(game.possible_moves, game.allow_cancel))
+    try:
+        return await asyncio.wait_for(read_choice(seat, option_count, n, game.allow_cancel), timeout)
+    except asyncio.TimeoutError:
+        raise TimedOut(seat.name) from None
+
+
+async def read_choice(seat, option_count, n, allow_cancel):
+    while True:
+        seat.writer.write(b'> ')
+        await seat.writer.drain()
+        line = await seat.reader.readline()
+        if not line:
+            raise Disconnected(seat.name)
+        choice = parse_choice(line.decode(errors='replace'), option_count, n, allow_cancel)
+        if choice is not None:
+            return choice
+        seat.send(['Invalid choice'])
+
+
+async def play_table(seats, rng, timeout=None):
+    game = Game(verbose=False, rng=rng, sink=TableSink(seats))
+    game.deal(len(seats))
+    for i, seat in enumerate(seats):
+        seat.name = game.players[i].name
+        seat.send([f'You are {seat.name}'])
+    try:
+        while True:
+            game.step_until_decision()
+            if game.state == State.GAME_OVER:
+                break
+            game.apply(await ask(seats[game.active_player_ix], game, timeout))
+        scores = ', '.join(f'{p.name}: {p.score}' for p in game.players)
+        for seat in seats:
+            seat.send(['Game over', f'Scores: {scores}'])
+    except Disconnected as e:
+        for seat in seats:
+            seat.send([f'{e} disconnected. Game over'])
+    except TimedOut as e:
+        for seat in seats:
+            seat.send([f'{e} did not answer in time. Game over'])
+    except ConnectionError:
+        pass
+    finally:
+        for seat in seats:
+            seat.writer.close()
+
+
+class Server:
+    # timeout is the seconds a player has for each decision, or None for no
+    # limit. A player who runs out of time ends the game
+    def __init__(self, player_count=2, seed=None, timeout=None):
+        self.player_count = player_count
+        self.rng = CounterRNG(seed)
+        self.timeout = timeout
+        self.waiting = []
+        self.tables = set()
+
+    async def connect(self, reader, writer):
+        self.waiting = [s for s in self.waiting if not s.writer.is_closing()]
+        seat = Seat(reader, writer)
+        self.waiting.append(seat)
+        if len(self.waiting) < self.player_count:
+            writer.write(b'Waiting for players\n')
+            seat.watcher = asyncio.create_task(self.watch(seat))
+            return
+        seats, self.waiting = self.waiting, []
+        for s in seats:
+            if s.watcher is not None:
+                s.watcher.cancel()
+                s.watcher = None
+        table = asyncio.create_task(play_table(seats, CounterRNG(self.rng.getrandbits(64)), self.timeout))
+        # Keep a reference so running tables are not garbage collected
+        self.tables.add(table)
+        table.add_done_callback(self.tables.discard)
+
+    async def watch(self, seat):
+        # A waiting player who closes their end only shows as EOF on the
+        # reader, so it is read until then. Input before the table starts is
+        # ignored
+        try:
+            while await seat.reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        if seat in self.waiting:
+            self.waiting.remove(seat)
+        seat.writer.close()
+
+    async def serve(self, host, port):
+        # A deep backlog lets a burst of players connect at once
+        server = await asyncio.start_server(self.connect, host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Host games over TCP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('-p', '--players', type=int, default=2)
+    parser.add_argument('-s', '--seed', type=int)
+    parser.add_argument('-t', '--timeout', type=float, default=300, help='seconds per decision, 0 for no limit')
+    args = parser.parse_args()
+    try:
+        asyncio.run(Server(args.players, args.seed, args.timeout or None).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
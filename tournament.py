@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import Pool
+
+from mottainai import Game
+from rng import CounterRNG
+from agents import RandomAgent
+from replay import GameRecord, write_record
+
+GameResult = namedtuple('GameResult', 'index seed turns scores record')
+
+
+def game_seed(tournament_seed, index):
+    # Game index's own stream of the tournament's generator, reached in O(1)
+    # by any process, so neighbouring games get unrelated streams
+    return CounterRNG(tournament_seed).fork(index).getrandbits(64)
+
+
+def play_game(seed, player_count, agent_factory=RandomAgent, verbose=False, record=False):
+    game = Game(verbose=verbose, rng=CounterRNG(seed))
+    if record:
+        game.record = GameRecord()
+    agents = [agent_factory(random.Random(f'{seed}:{i}')) for i in range(player_count)]
+    game.start_game(player_count, agents)
+    return game
+
+
+def play_chunk(args):
+    tournament_seed, start, stop, player_count, agent_factory, record = args
+    results = []
+    for index in range(start, stop):
+        seed = game_seed(tournament_seed, index)
+        game = play_game(seed, player_count, agent_factory, record=record)
+        results.append(GameResult(
+            index, seed, game.turn_number, tuple(p.score for p in game.players),
+            game.record.to_bytes() if record else None,
+        ))
+    return results
+
+
+def run_tournament(games, player_count=2, seed=0, processes=None, chunk_size=256, agent_factory=RandomAgent,
+                   record=False):
+    chunks = [
+        (seed, start, min(start + chunk_size, games), player_count, agent_factory, record)
+        for start in range(0, games, chunk_size)
+    ]
+    if processes == 1:
+        for chunk in chunks:
+            yield from play_chunk(chunk)
+        return
+    with Pool(processes) as pool:
+        for results in pool.imap_unordered(play_chunk, chunks):
+            yield from results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play many headless games in parallel')
+    parser.add_argument('-n', '--games', type=int, default=10000)
+    parser.add_argument('-p', '--players', type=int, default=2)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count())
+    parser.add_argument('-c', '--chunk-size', type=int, default=256)
+    parser.add_argument('-o', '--output', help='write one CSV row per game')
+    parser.add_argument('-r', '--record',
+                        help='write every game to a binary record file, about 260 bytes for a two player random '
+                             'game, see replay.py')
+    parser.add_argument('--replay', type=int, metavar='SEED', help='replay a single game verbosely')
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        play_game(args.replay, args.players, verbose=True)
+        return
+
+    wins = [0] * args.players
+    out = open(args.output, 'w', newline='') if args.output else None
+    writer = csv.writer(out) if out else None
+    if writer:
+        writer.writerow(['index', 'seed', 'turns'] + [f'player_{i + 1}' for i in range(args.players)])
+    records = open(args.record, 'wb') if args.record else None
+
+    start = time.perf_counter()
+    results = run_tournament(args.games, args.players, args.seed, args.processes, args.chunk_size,
+                             record=records is not None)
+    for result in results:
+        best = max(result.scores)
+        for i, score in enumerate(result.scores):
+            if score == best:
+                wins[i] += 1
+        if writer:
+            writer.writerow([result.index, result.seed, result.turns] + list(result.scores))
+        if records:
+            write_record(records, result.record)
+    elapsed = time.perf_counter() - start
+    if out:
+        out.close()
+    if records:
+        records.close()
+
+    print(f'{args.games} games in {elapsed:.2f}s - {args.games / elapsed:.1f} games/s on {args.processes} processes')
+    for i, w in enumerate(wins):
+        print(f'Player {i + 1}: {w} wins (ties included)')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
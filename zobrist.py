@@ -0,0 +1,216 @@
+import random
+from array import array
+
+from mottainai import PLAYER_ZONES
+from cardset import CardSet, CardSetHand
+
+# Zobrist hashing: every (card, zone, owner) has a random 64-bit key and a
+# position hashes to the XOR of the keys of where its cards are, together
+# with keys for the active player, tasks, State and the progress of the
+# current task. Zones of ZobristBackend keep their own hash up to date on
+# every change, so moving a card costs a couple of XORs and game_hash() only
+# combines a few numbers per player. The deck is not hashed: its contents
+# follow from every other zone, and its order is not part of a position.
+
+_keys = {}
+
+
+def key(*parts):
+    # Keys are derived from their name, so they are the same in every
+    # process and every run
+    k = _keys.get(parts)
+    if k is None:
+        k = _keys[parts] = random.Random(repr(parts)).getrandbits(64)
+    return k
+
+
+_location_keys = {}
+
+
+def location_keys(*location):
+    # Keys indexed by card id for one zone
+    keys = _location_keys.get(location)
+    if keys is None:
+        keys = _location_keys[location] = [key(*location, card_id) for card_id in range(64)]
+    return keys
+
+
+def mask_hash(keys, mask):
+    h = 0
+    while mask:
+        low = mask & -mask
+        h ^= keys[low.bit_length() - 1]
+        mask ^= low
+    return h
+
+
+_get_mask = CardSet.mask.__get__
+_set_mask = CardSet.mask.__set__
+_get_hand_mask = CardSetHand.mask.__get__
+_set_hand_mask = CardSetHand.mask.__set__
+_get_visible_mask = CardSetHand.visible_mask.__get__
+_set_visible_mask = CardSetHand.visible_mask.__set__
+
+
+class HashedCardSet(CardSet):
+    # Every write of mask goes through the property, so the hash follows
+    # all CardSet operations. keys is set by attach()
+    __slots__ = ('keys', 'hash')
+
+    def __init__(self, cards=()):
+        self.keys = None
+        self.hash = 0
+        super().__init__(cards)
+
+    def _set(self, mask):
+        if self.keys is not None:
+            self.hash ^= mask_hash(self.keys, _get_mask(self) ^ mask)
+        _set_mask(self, mask)
+
+    mask = property(_get_mask, _set)
+
+    def copy(self):
+        other = super().copy()
+        other.keys = self.keys
+        other.hash = self.hash
+        return other
+
+
+class HashedCardSetHand(CardSetHand):
+    # Revealed cards hash differently from hidden ones
+    __slots__ = ('keys', 'visible_keys', 'hash')
+
+    def __init__(self, hand_cards=()):
+        self.keys = None
+        self.visible_keys = None
+        self.hash = 0
+        super().__init__(hand_cards)
+
+    def _set(self, mask):
+        if self.keys is not None:
+            self.hash ^= mask_hash(self.keys, _get_hand_mask(self) ^ mask)
+        _set_hand_mask(self, mask)
+
+    def _set_visible(self, mask):
+        if self.visible_keys is not None:
+            self.hash ^= mask_hash(self.visible_keys, _get_visible_mask(self) ^ mask)
+        _set_visible_mask(self, mask)
+
+    mask = property(_get_hand_mask, _set)
+    visible_mask = property(_get_visible_mask, _set_visible)
+
+    def copy(self):
+        other = super().copy()
+        other.keys = self.keys
+        other.visible_keys = self.visible_keys
+        other.hash = self.hash
+        return other
+
+
+class ZobristBackend:
+    zone = HashedCardSet
+    hand = HashedCardSetHand
+
+
+def attach(game):
+    # Binds the zones of a ZobristBackend game to their keys. Call once
+    # after dealing; clones keep their zones' keys and hashes
+    zones = [(game.floor, location_keys('floor'))]
+    for i, p in enumerate(game.players):
+        zones += [(getattr(p, zone), location_keys(zone, i)) for zone in PLAYER_ZONES]
+    for zone, keys in zones:
+        if not isinstance(zone, (HashedCardSet, HashedCardSetHand)):
+            raise TypeError('Zobrist hashing needs a game created with backend=ZobristBackend')
+        zone.keys = keys
+        zone.hash = mask_hash(keys, zone.mask)
+    for i, p in enumerate(game.players):
+        p.hand.visible_keys = location_keys('visible', i)
+        p.hand.hash ^= mask_hash(p.hand.visible_keys, p.hand.visible_mask)
+    return game
+
+
+def game_hash(game):
+    # Unattached zones keep a hash of 0, so hashing such a game would give
+    # every position the same few hashes
+    if getattr(game.floor, 'keys', None) is None or \
+            not all(getattr(p.hand, 'visible_keys', None) for p in game.players):
+        raise ValueError('game_hash() needs a ZobristBackend game passed to attach() after dealing')
+    h = game.floor.hash
+    for p in game.players:
+        h ^= p.hand.hash ^ p.gallery.hash ^ p.gift_shop.hash ^ p.helpers.hash ^ \
+            p.craft_bench.hash ^ p.sales.hash ^ p.waiting_area.hash
+    return h ^ progress_hash(game)
+
+
+def rehash(game):
+    # game_hash() from the zones' contents rather than their kept hashes
+    h = mask_hash(location_keys('floor'), game.floor.mask)
+    for i, p in enumerate(game.players):
+        for zone in PLAYER_ZONES:
+            h ^= mask_hash(location_keys(zone, i), getattr(p, zone).mask)
+        h ^= mask_hash(location_keys('visible', i), p.hand.visible_mask)
+    return h ^ progress_hash(game)
+
+
+def progress_hash(game):
+    # Everything but the zones
+    h = key('state', game.state.value) ^ key('active', game.active_player_ix)
+    for i, p in enumerate(game.players):
+        if p.task:
+            h ^= key('task', i, p.task.id)
+        if p.initial_task:
+            h ^= key('initial_task', i, p.initial_task.id)
+    # Where the turn is: the task being performed and how far along it is
+    task = game.current_task_to_perform
+    if task:
+        h ^= key('current_task', task.id, game.current_task_is_of_opponent)
+    if game.actions_to_perform is not None:
+        h ^= key('actions', game.actions_to_perform, game.current_action_num)
+    if game.opponents_with_tasks is not None:
+        h ^= key('opponents_left', len(game.opponents_with_tasks))
+    if game.completed_work:
+        h ^= key('completed_work', game.completed_work.id)
+    for depth, state in enumerate(game.next_states):
+        h ^= key('next_state', depth, state.value)
+    return h
+
+
+class TranspositionTable:
+    # A fixed number of slots, indexed by the low bits of the hash. A slot
+    # is overwritten when it is empty, holds the same position, was written
+    # before the last new_search(), or holds an entry of no greater depth.
+    def __init__(self, size_bits=16):
+        size = 1 << size_bits
+        self.index_mask = size - 1
+        self.hashes = array('Q', bytes(8 * size))
+        self.depths = array('i', bytes(4 * size))
+        self.generations = array('I', bytes(4 * size))
+        self.values = [None] * size
+        self.generation = 1
+        self.hits = 0
+        self.misses = 0
+
+    def new_search(self):
+        self.generation += 1
+
+    def get(self, h):
+        i = h & self.index_mask
+        if self.hashes[i] == h and self.values[i] is not None:
+            self.hits += 1
+            return self.values[i]
+        self.misses += 1
+        return None
+
+    def put(self, h, value, depth=0):
+        i = h & self.index_mask
+        if self.values[i] is None or self.hashes[i] == h or \
+                self.generations[i] != self.generation or depth >= self.depths[i]:
+            self.hashes[i] = h
+            self.depths[i] = depth
+            self.generations[i] = self.generation
+            self.values[i] = value
+            return True
+        return False
+
+    def __len__(self):
+        return sum(v is not None for v in self.values)